@@ -0,0 +1,63 @@
+# Import time of the gitstat modules and startup time of `gitstat_cli.py`, each measured in a fresh interpreter.
+# Prints JSON. Heavy dependencies that a module pulled in are listed under "loaded".
+#
+# python benchmarks/bench_import.py [--repeat N] [--output results.json]
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+MODULES = ["gitstat_models", "gitparse", "gitparse_cache", "gitstat", "gitstat_cli", "gitstat_pd"]
+HEAVY_DEPENDENCIES = ["requests", "dateutil", "numpy", "pandas", "matplotlib"]
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+def _environment():
+	return dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT] + [path for path in os.environ.get("PYTHONPATH", "").split(os.pathsep) if path]))
+
+def import_time(module:str, repeat:int) -> dict:
+	best = None
+	loaded = []
+	for _ in range(repeat):
+		result = json.loads(subprocess.check_output([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_DEPENDENCIES)], cwd=ROOT, env=_environment()))
+		best = result["seconds"] if best is None else min(best, result["seconds"])
+		loaded = result["loaded"]
+	return {"module": module, "seconds": best, "loaded": loaded}
+
+def cli_startup(repeat:int) -> float:
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		subprocess.check_output([sys.executable, os.path.join(ROOT, "gitstat_cli.py"), "--help"], cwd=ROOT, env=_environment())
+		seconds = time.perf_counter() - start
+		best = seconds if best is None else min(best, seconds)
+	return best
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Measure the import time of the gitstat modules")
+	parser.add_argument("--repeat", type=int, default=5, help="Number of runs per module. The fastest one is reported.")
+	parser.add_argument("--output", help="Write the results to this file instead of stdout")
+	arguments = parser.parse_args()
+
+	report = {
+		"timestamp": int(time.time()),
+		"python": sys.version.split()[0],
+		"modules": [import_time(module, arguments.repeat) for module in MODULES],
+		"cli_startup_seconds": cli_startup(arguments.repeat),
+	}
+	if arguments.output:
+		with open(arguments.output, "w") as output:
+			json.dump(report, output, indent=2)
+	else:
+		print(json.dumps(report, indent=2))
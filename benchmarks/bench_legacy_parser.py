@@ -0,0 +1,111 @@
+# Per-commit cost of `gitparse.GitLogParser.parse_lines` for `git log` output with dates in the default format
+# (parsed by dateutil) and with `--date=unix` (see `GitLogParser.command`). `BaselineLogParser` is the parser before
+# the prefix dispatch and `--date=unix` were introduced, and is measured on the default dates as the baseline.
+#
+# python benchmarks/bench_legacy_parser.py [commit count]
+
+import os
+import sys
+import re
+import time
+import logging
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gitparse
+
+DEFAULT_DATE = "Mon Oct 16 12:{minute:02d}:00 2023 +0200"
+UNIX_DATE = "{timestamp}"
+
+def synthetic_log(commit_count:int, date_format:str) -> str:
+	lines = []
+	for i in range(commit_count):
+		lines.append(f"commit {i:040x}")
+		if i % 10 == 0:
+			lines.append(f"Merge: {i + 1:07x} {i + 2:07x}")
+		lines.append(f"Author: Author {i % 50} <author{i % 50}@example.com>")
+		lines.append("Date:   " + date_format.format(minute=i % 60, timestamp=1697450400 + i * 60))
+		lines.append("")
+		lines.append(f"    Commit number {i}")
+		lines.append("")
+		lines.append(f"    Change-Id: I{i:040x}")
+		lines.append("")
+	return "\n".join(lines)
+
+# The line dispatch of `GitLogParser.parse_lines` before it was replaced by the prefix checks: one `re.match` per line
+# type, patterns compiled on every call and every date parsed by dateutil.
+class BaselineLogParser(gitparse.GitLogParser):
+
+	def parse_commit_hash(self, next_line:int, commit:gitparse.CommitData):
+		if commit.commit_hash is not None:
+			self.commits.append(commit)
+			commit = gitparse.CommitData()
+		commit.commit_hash = re.match('commit (.*)', next_line, re.IGNORECASE).group(1)
+		return commit
+
+	def parse_author(self, next_line:str):
+		m = re.compile('Author: (.*) <(.*)>').match(next_line)
+		return gitparse.AUTHORS.intern(m.group(1), m.group(2))
+
+	def parse_date(self, next_line:str, commit:str):
+		m = re.compile(r'Date:\s+(.*)$').match(next_line)
+		commit.date = gitparse.parse_datetime(m.group(1))
+
+	def parse_change_id(self, next_line:str, commit:gitparse.CommitData):
+		commit.change_id = re.compile(r'    Change-Id:\s*(.*)').match(next_line).group(1)
+
+	def parse_lines(self, raw_lines:List[str], commit:gitparse.CommitData=None):
+		if commit is None:
+			commit = gitparse.CommitData()
+		for next_line in raw_lines.splitlines():
+			if len(next_line.strip()) == 0:
+				pass
+			elif bool(re.match('commit', next_line, re.IGNORECASE)):
+				commit_orig = self.parse_commit_hash(next_line, commit)
+				if self.stop_at_hash is not None and commit_orig.commit_hash == self.stop_at_hash:
+					return self.commits[-1] if len(self.commits) > 0 else None
+				commit = commit_orig
+			elif bool(re.match('merge:', next_line, re.IGNORECASE)):
+				pass
+			elif bool(re.match('author:', next_line, re.IGNORECASE)):
+				commit.author = self.parse_author(next_line)
+			elif bool(re.match('date:', next_line, re.IGNORECASE)):
+				self.parse_date(next_line, commit)
+			elif bool(re.match('    ', next_line, re.IGNORECASE)):
+				self.parse_commit_msg(next_line, commit)
+			elif bool(re.match('    change-id: ', next_line, re.IGNORECASE)):
+				self.parse_change_id(next_line, commit)
+
+			if self.start_date is not None and commit.date is not None and commit.date < self.start_date:
+				commit.ignore = True
+
+		if len(self.commits) != 0 and not commit.ignore:
+			if not len(commit_orig.commit_hash) == 40 or not bool(re.match(r'[a-z0-9]+', commit_orig.commit_hash)):
+				commit.ignore = True
+			else:
+				self.commits.append(commit)
+		return commit
+
+def per_commit(log_text:str, commit_count:int, repeat:int=3, parser_type:type=gitparse.GitLogParser) -> float:
+	best = None
+	for _ in range(repeat):
+		parser = parser_type(worker_pool=gitparse.gitparse_worker.GitWorkerPool())
+		start = time.perf_counter()
+		parser.parse_lines(log_text)
+		elapsed = time.perf_counter() - start
+		assert len(parser.commits) == commit_count
+		best = elapsed if best is None else min(best, elapsed)
+	return best / commit_count
+
+if __name__ == "__main__":
+	logging.disable(logging.INFO)
+	commit_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	default_log = synthetic_log(commit_count, DEFAULT_DATE)
+	baseline_cost = per_commit(default_log, commit_count, parser_type=BaselineLogParser)
+	default_cost = per_commit(default_log, commit_count)
+	unix_cost = per_commit(synthetic_log(commit_count, UNIX_DATE), commit_count)
+	print(f"{commit_count} commits")
+	print(f"baseline (regex dispatch, dateutil): {baseline_cost * 1e6:8.2f} us/commit")
+	print(f"prefix dispatch, dateutil:           {default_cost * 1e6:8.2f} us/commit ({baseline_cost / default_cost:.1f}x)")
+	print(f"prefix dispatch, --date=unix:        {unix_cost * 1e6:8.2f} us/commit ({baseline_cost / unix_cost:.1f}x)")
@@ -0,0 +1,178 @@
+# Times each stage of the pipeline on a synthetic repository (see `synthetic_repo.py`) and prints the results as JSON:
+#
+# parse:        `GitLogParser.parse_lines` on `git log` output (no stats)
+# mine:         `GitLogParser.update_stats` for the parsed commits (git diff-tree workers)
+# single_pass:  `gitparse.iter_commits` (`git log --shortstat`, commits with stats)
+# insert:       `GitStatCache.checkpoint` and `complete_ingest` into an empty cache, with the commits in batches of
+#               `INGEST_BATCH_SIZE` (oldest first), like the writer of the ingestion
+# aggregate:    `GitStatCache.aggregate_commits` for every interval
+# frame:        `GitStatPd.generate_frames` for every interval
+#
+# Every stage reports its duration, commits/s and the peak memory allocated by Python during the stage. The peak is measured
+# with `tracemalloc` in an extra run after the timed ones (tracing slows the stage down), so it only covers the stage itself.
+# Memory used by the git processes is not included.
+#
+# python benchmarks/bench_pipeline.py [--commits N] [--merge-ratio R] [--files N] [--files-per-commit N] [--authors N]
+#                                     [--intervals 3600,86400] [--repeat N] [--output results.json] [--directory DIR]
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gitparse
+import gitparse_worker
+from gitparse_cache import GitStatCache
+from gitstat_ingest import INGEST_BATCH_SIZE
+from gitstat_models import *
+from synthetic_repo import create_repository, spec_arguments, spec_from_arguments
+
+log = logging.getLogger(gitparse.GIT_PARSE_LOGGER_ID)
+
+BENCHMARK_TAG = "benchmark"
+BENCHMARK_REPO = "synthetic"
+
+# Peak memory in KiB allocated by Python while running `function`. Memory allocated before the call is not counted.
+def peak_traced(function, argument=None) -> int:
+	tracemalloc.start()
+	try:
+		function(argument) if argument is not None else function()
+		return tracemalloc.get_traced_memory()[1] // 1024
+	finally:
+		tracemalloc.stop()
+
+class Benchmark:
+
+	def __init__(self, directory:str, intervals:List[int], repeat:int=1):
+		self.config = GitStatConfig(os.path.join(directory, "repos"), os.path.join(directory, "cache"), network=None)
+		self.repo_meta = RepoMeta(1, "master", None, BENCHMARK_REPO, tag=BENCHMARK_TAG)
+		self.intervals = intervals
+		self.repeat = repeat
+		self.results = []
+
+	@property
+	def repo_directory(self) -> str:
+		return self.config.repo_directory(self.repo_meta)
+
+	# Run `function` `repeat` times and record the fastest run, then once more to measure its memory (see `peak_traced`).
+	# `function` returns the number of commits processed.
+	def stage(self, name:str, function, setup=None):
+		best = None
+		commit_count = 0
+		for _ in range(self.repeat):
+			argument = setup() if setup else None
+			start = time.perf_counter()
+			commit_count = function(argument) if setup else function()
+			duration = time.perf_counter() - start
+			best = duration if best is None else min(best, duration)
+		peak = peak_traced(function, setup() if setup else None)
+		self.results.append({
+			"stage": name,
+			"commits": commit_count,
+			"seconds": best,
+			"commits_per_second": commit_count / best if best > 0 else None,
+			"peak_traced_kib": peak,
+		})
+		log.info(f"{name}: {commit_count} commits in {best:.3f}s, {peak} KiB")
+
+	def _parse(self) -> gitparse.GitLogParser:
+		output = subprocess.check_output(gitparse.GitLogParser.command(), cwd=self.repo_directory).decode("utf8", "ignore")
+		parser = gitparse.GitLogParser(self.repo_directory, worker_pool=gitparse_worker.GitWorkerPool())
+		parser.parse_lines(output)
+		return parser
+
+	def _mine(self, parser:gitparse.GitLogParser) -> int:
+		parser.update_stats()
+		parser.worker_pool.close()
+		return len(parser.commits)
+
+	# The commits in batches, as the ingestion workers send them to the writer
+	def _batches(self) -> List[gitparse.CommitBatch]:
+		batches = [gitparse.CommitBatch()]
+		for commit in gitparse.iter_commits_oldest_first(self.repo_directory):
+			if len(batches[-1]) == INGEST_BATCH_SIZE:
+				batches.append(gitparse.CommitBatch())
+			batches[-1].append(commit)
+		return batches
+
+	def _insert(self, cache:GitStatCache, batches:List[gitparse.CommitBatch], head:str) -> int:
+		self.repo_meta.last_commit_hash = None
+		commit_count = sum([cache.checkpoint(self.repo_meta, batch) for batch in batches])
+		cache.complete_ingest(self.repo_meta, head)
+		cache.db.close()
+		return commit_count
+
+	def _empty_cache(self) -> GitStatCache:
+		shutil.rmtree(self.config.cache_path, ignore_errors=True)
+		return GitStatCache(self.config)
+
+	def _aggregate(self, cache:GitStatCache) -> int:
+		return sum([sum([entry.commit_count for entry in cache.aggregate_commits(interval, BENCHMARK_TAG, [BENCHMARK_REPO])]) for interval in self.intervals]) // len(self.intervals)
+
+	def _stats_pd(self):
+		import gitstat_pd
+		return gitstat_pd.GitStatPd(self.config)
+
+	def _frame(self, stats_pd) -> int:
+		import gitstat_pd
+		frames = stats_pd.generate_frames(BENCHMARK_TAG, [self.repo_meta], self.intervals)
+		column = gitstat_pd.GitStatData.get_column_name("commit_count", BENCHMARK_TAG, self.intervals[0])
+		return int(frames[self.intervals[0]][column].sum())
+
+	def run(self):
+		self.stage("parse", lambda: len(self._parse().commits))
+		self.stage("mine", self._mine, setup=self._parse)
+		self.stage("single_pass", lambda: len(gitparse.get_commits(self.repo_directory)))
+		batches = self._batches()
+		head = gitparse.head_hash(self.repo_directory)
+		self.stage("insert", lambda cache: self._insert(cache, batches, head), setup=self._empty_cache)
+		cache = GitStatCache(self.config)
+		self.stage("aggregate", lambda: self._aggregate(cache))
+		self.stage("frame", self._frame, setup=self._stats_pd)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the gitstat pipeline on a synthetic repository")
+	spec_arguments(parser)
+	parser.add_argument("--intervals", default="3600,86400,604800", help="Comma separated period lengths in seconds")
+	parser.add_argument("--repeat", type=int, default=1, help="Number of runs per stage. The fastest one is reported.")
+	parser.add_argument("--output", help="Write the results to this file instead of stdout")
+	parser.add_argument("--directory", help="Work directory (default: a temporary directory that is removed afterwards)")
+	parser.add_argument("--verbose", action="store_true")
+	arguments = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO if arguments.verbose else logging.WARNING, format="%(message)s")
+	log.setLevel(logging.INFO if arguments.verbose else logging.WARNING)
+
+	directory = arguments.directory or tempfile.mkdtemp(prefix="gitstat-benchmark-")
+	spec = spec_from_arguments(arguments)
+	try:
+		benchmark = Benchmark(directory, [int(interval) for interval in arguments.intervals.split(",")], arguments.repeat)
+		start = time.perf_counter()
+		create_repository(benchmark.repo_directory, spec)
+		generate_seconds = time.perf_counter() - start
+		benchmark.run()
+		report = {
+			"timestamp": int(time.time()),
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"repository": dict(spec.as_dict, generate_seconds=generate_seconds),
+			"intervals": benchmark.intervals,
+			"stages": benchmark.results,
+		}
+		if arguments.output:
+			with open(arguments.output, "w") as output:
+				json.dump(report, output, indent=2)
+		else:
+			print(json.dumps(report, indent=2))
+	finally:
+		if not arguments.directory:
+			shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,121 @@
+# Generates local git repositories with a given number of commits, merges, files changed per commit and authors.
+# The history is written with `git fast-import`, so large repositories are created in seconds.
+#
+# python benchmarks/synthetic_repo.py <directory> [--commits N] [--merge-ratio R] [--files N] [--files-per-commit N] [--authors N]
+
+import os
+import random
+import argparse
+import subprocess
+
+class SyntheticRepoSpec:
+
+	# `commit_count`: number of commits on the default branch (merges and the commits they merge included)
+	# `merge_ratio`: fraction of the commits that are merges of a one-commit side branch
+	# `file_count`: number of files in the repository
+	# `files_per_commit`: number of files each commit rewrites
+	# `lines_per_file`: number of lines written to a file when it changes
+	# `author_count`: number of distinct authors
+	# `interval`: seconds between two commits
+	def __init__(self, commit_count:int=1000, merge_ratio:float=0.1, file_count:int=100, files_per_commit:int=3, lines_per_file:int=20,
+				 author_count:int=10, interval:int=3600, start:int=None, seed:int=0):
+		self.commit_count = commit_count
+		self.merge_ratio = merge_ratio
+		self.file_count = file_count
+		self.files_per_commit = min(files_per_commit, file_count)
+		self.lines_per_file = lines_per_file
+		self.author_count = author_count
+		self.interval = interval
+		self.start = start if start is not None else 1600000000
+		self.seed = seed
+
+	@property
+	def as_dict(self):
+		return {
+			"commit_count": self.commit_count,
+			"merge_ratio": self.merge_ratio,
+			"file_count": self.file_count,
+			"files_per_commit": self.files_per_commit,
+			"lines_per_file": self.lines_per_file,
+			"author_count": self.author_count,
+			"interval": self.interval,
+			"start": self.start,
+			"seed": self.seed,
+		}
+
+def _data(stream:list, text:str):
+	encoded = text.encode("utf8")
+	stream.append(f"data {len(encoded)}\n".encode("utf8"))
+	stream.append(encoded)
+	stream.append(b"\n")
+
+class _Writer:
+
+	def __init__(self, spec:SyntheticRepoSpec):
+		self.spec = spec
+		self.random = random.Random(spec.seed)
+		self.stream = []
+		self.mark = 0
+		self.timestamp = spec.start
+
+	def _commit(self, branch:str, parents:list) -> int:
+		spec = self.spec
+		self.mark = self.mark + 1
+		self.timestamp = self.timestamp + spec.interval
+		author = self.random.randrange(spec.author_count)
+		identity = f"Author {author} <author{author}@example.com> {self.timestamp} +0000"
+		self.stream.append(f"commit refs/heads/{branch}\nmark :{self.mark}\nauthor {identity}\ncommitter {identity}\n".encode("utf8"))
+		message = f"Merge commit {self.mark}" if len(parents) > 1 else f"Change {self.mark}\n\nChange-Id: I{self.mark:040x}"
+		_data(self.stream, message)
+		if parents:
+			self.stream.append(f"from :{parents[0]}\n".encode("utf8"))
+		for parent in parents[1:]:
+			self.stream.append(f"merge :{parent}\n".encode("utf8"))
+		for file_index in self.random.sample(range(spec.file_count), spec.files_per_commit):
+			self.stream.append(f"M 644 inline src/file_{file_index}.txt\n".encode("utf8"))
+			_data(self.stream, "".join(f"{self.random.getrandbits(64):016x}\n" for _ in range(spec.lines_per_file)))
+		self.stream.append(b"\n")
+		return self.mark
+
+	def write(self) -> bytes:
+		spec = self.spec
+		head = None
+		count = 0
+		while count < spec.commit_count:
+			if head is not None and count + 2 <= spec.commit_count and self.random.random() < spec.merge_ratio:
+				side = self._commit("side", [head])
+				head = self._commit("master", [head, side])
+				count = count + 2
+			else:
+				head = self._commit("master", [head] if head is not None else [])
+				count = count + 1
+		self.stream.append(b"reset refs/heads/side\nfrom 0000000000000000000000000000000000000000\n\n")
+		return b"".join(self.stream)
+
+# Create a repository at `directory` (which must not exist) with the default branch "master" checked out
+def create_repository(directory:str, spec:SyntheticRepoSpec):
+	os.makedirs(directory)
+	subprocess.run(["git", "init", "--quiet", "--initial-branch=master", directory], check=True)
+	subprocess.run(["git", "fast-import", "--quiet"], input=_Writer(spec).write(), cwd=directory, check=True)
+	subprocess.run(["git", "checkout", "--quiet", "--force", "master"], cwd=directory, check=True)
+
+def spec_arguments(parser:argparse.ArgumentParser):
+	parser.add_argument("--commits", type=int, default=1000)
+	parser.add_argument("--merge-ratio", type=float, default=0.1)
+	parser.add_argument("--files", type=int, default=100)
+	parser.add_argument("--files-per-commit", type=int, default=3)
+	parser.add_argument("--lines", type=int, default=20)
+	parser.add_argument("--authors", type=int, default=10)
+	parser.add_argument("--seed", type=int, default=0)
+
+def spec_from_arguments(arguments) -> SyntheticRepoSpec:
+	return SyntheticRepoSpec(commit_count=arguments.commits, merge_ratio=arguments.merge_ratio, file_count=arguments.files,
+							 files_per_commit=arguments.files_per_commit, lines_per_file=arguments.lines, author_count=arguments.authors,
+							 seed=arguments.seed)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Create a synthetic git repository")
+	parser.add_argument("directory")
+	spec_arguments(parser)
+	arguments = parser.parse_args()
+	create_repository(arguments.directory, spec_from_arguments(arguments))
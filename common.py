@@ -1,6 +1,8 @@
 import logging
 import os
 
+GIT_PARSE_LOGGER_ID = "gitparse_logger"
+
 # Ensure that the specified is a valid directory
 def ensure_path(path):
 	if not os.path.isdir(path):
@@ -1,24 +1,50 @@
 import os
-import copy
+import array
+import itertools
 import subprocess
 import datetime
 import re
-import concurrent.futures
-import multiprocessing
-from dateutil import parser as date_parser
-from typing import List, Dict
+import codecs
+import shlex
+from typing import List, Iterable, Iterator
 import logging
 
-GIT_PARSE_LOGGER_ID = "gitparse_logger"
+from common import GIT_PARSE_LOGGER_ID
+import gitparse_worker
+import gitstat_metrics
 
 log = logging.getLogger(GIT_PARSE_LOGGER_ID)
 
+# Single-pass mining: every commit is emitted as one record by `git log --shortstat`.
+# Records start with RECORD_SEPARATOR and the header fields are delimited by FIELD_SEPARATOR.
+RECORD_SEPARATOR = "\x1e"
+FIELD_SEPARATOR = "\x1f"
+LOG_FORMAT = "%x1e%H%x1f%P%x1f%an%x1f%ae%x1f%at%x1f%ct%x1f%B%x1f"
+STREAM_CHUNK_SIZE = 64 * 1024
+# Number of commits whose stats are looked up at a time by `iter_commits` with `known_stats`
+STATS_LOOKUP_BATCH_SIZE = 256
+
+CHANGE_ID_PATTERN = re.compile(r'Change-Id:\s*(.*)')
+
+# Line patterns of the `GitLogParser` (default `git log` output)
+COMMIT_LINE_PATTERN = re.compile('commit (.*)', re.IGNORECASE)
+AUTHOR_LINE_PATTERN = re.compile('Author: (.*) <(.*)>')
+DATE_LINE_PATTERN = re.compile(r'Date:\s+(.*)$')
+LEGACY_CHANGE_ID_PATTERN = re.compile(r'    Change-Id:\s*(.*)')
+COMMIT_HASH_PATTERN = re.compile(r'[a-z0-9]+')
+
 class UnexpectedLineError(Exception):
 	def __init__(self, line):
 		super(UnexpectedLineError, self).__init__('ERROR: Unexpected Line: ' + line)
 
+# `git log` failed before listing all commits (i.e. a missing object in a partial clone)
+class GitLogError(Exception):
+	pass
+
 class Author(object):
 
+	__slots__ = ('name', 'email')
+
 	def __init__(self, name:str="", email:str=""):
 		self.name = name
 		self.email = email
@@ -35,24 +61,63 @@ class Author(object):
 	def __eq__(self, other):
 		return self.name == other.name and self.email == other.email
 
+	def __hash__(self):
+		return hash((self.name, self.email))
+
+# Interns authors, so that all commits of an author share one `Author` (which must not be modified), and numbers them
+# for `CommitBatch`.
+class AuthorTable(object):
+
+	def __init__(self):
+		self.authors = []
+		self._ids = dict()
+
+	def __len__(self):
+		return len(self.authors)
+
+	def __getitem__(self, author_id:int) -> Author:
+		return self.authors[author_id]
+
+	def id(self, name:str, email:str) -> int:
+		key = (name, email)
+		author_id = self._ids.get(key)
+		if author_id is None:
+			author_id = len(self.authors)
+			self._ids[key] = author_id
+			self.authors.append(Author(name, email))
+		return author_id
+
+	def intern(self, name:str, email:str) -> Author:
+		return self.authors[self.id(name, email)]
+
+# Authors of the commits parsed by this process
+AUTHORS = AuthorTable()
+
 class CommitData(object):
 
-	def __init__(self, commit_hash:str=None, author:Author=Author(), message:str=None,
+	__slots__ = ('commit_hash', 'author', 'message', 'date', 'is_merge', 'ignore', 'change_id', 'files_changed', 'insertions', 'deletions',
+				 'total', 'parents', 'commit_timestamp')
+
+	def __init__(self, commit_hash:str=None, author:Author=None, message:str=None,
 				 date:int=None, is_merge:bool=False, change_id:str=None, files_changed:int=0, insertions:int=0, deletions:int=0, db_row=None):
+		self.message = message
+		self.is_merge = is_merge
+		self.ignore = False
+		self.change_id = change_id
+		self.files_changed = files_changed
+		self.parents = None
+		self.commit_timestamp = None
 		if db_row:
-			_, _, _, self.date, self.insertions, self.deletions, self.commit_hash = db_row
-			self.author = Author()	
+			_, _, _, self.date, self.insertions, self.deletions, self.commit_hash, *author = db_row
+			# Rows inserted before the author columns were added have no author
+			self.author = Author(author[0] or "", author[1] or "") if author else Author()
 		else:
 			self.commit_hash = commit_hash
-			self.author = author
-			self.message = message
+			self.author = author if author is not None else Author()
 			self.date = date
-			self.is_merge = is_merge
-			self.ignore = False
-			self.change_id = change_id
-			self.files_changed = files_changed
 			self.insertions = insertions
 			self.deletions = deletions
+		self.total = self.insertions + self.deletions
 
 	def __str__(self):
 		return f"{self.commit_hash}, {self.author}, {self.message}, {self.date}, {self.is_merge}, {self.change_id}, {self.files_changed}, {self.insertions}, {self.deletions}"
@@ -69,72 +134,156 @@ class CommitData(object):
 				and self.insertions == other.insertions
 				and self.deletions == other.deletions)
 
+# A struct-of-arrays list of commits for bulk paths (ingestion, cache inserts). Numeric fields are kept in `array`s and
+# authors as ids of `authors`, so a batch is a handful of objects regardless of its length and pickles compactly.
+# Iterating a batch creates the `CommitData` again.
+class CommitBatch(object):
+
+	def __init__(self, authors:AuthorTable=None):
+		self.authors = authors or AuthorTable()
+		self.hashes = []
+		self.author_ids = array.array('l')
+		self.dates = array.array('q')
+		self.commit_timestamps = array.array('q')
+		self.files_changed = array.array('q')
+		self.insertions = array.array('q')
+		self.deletions = array.array('q')
+		self.is_merge = array.array('b')
+		self.messages = []
+		self.change_ids = []
+		self.parents = []
+
+	@staticmethod
+	def from_commits(commits:Iterable[CommitData], authors:AuthorTable=None) -> 'CommitBatch':
+		batch = CommitBatch(authors)
+		for commit in commits:
+			batch.append(commit)
+		return batch
+
+	def __len__(self):
+		return len(self.hashes)
+
+	def append(self, commit:CommitData):
+		self.hashes.append(commit.commit_hash)
+		self.author_ids.append(self.authors.id(commit.author.name, commit.author.email))
+		self.dates.append(commit.date)
+		self.commit_timestamps.append(commit.commit_timestamp if commit.commit_timestamp is not None else commit.date)
+		self.files_changed.append(commit.files_changed)
+		self.insertions.append(commit.insertions)
+		self.deletions.append(commit.deletions)
+		self.is_merge.append(commit.is_merge)
+		self.messages.append(commit.message)
+		self.change_ids.append(commit.change_id)
+		self.parents.append(" ".join(commit.parents) if commit.parents is not None else None)
+
+	def __getitem__(self, i:int) -> CommitData:
+		commit = CommitData(commit_hash=self.hashes[i], author=self.authors[self.author_ids[i]], message=self.messages[i], date=self.dates[i],
+							is_merge=bool(self.is_merge[i]), change_id=self.change_ids[i], files_changed=self.files_changed[i],
+							insertions=self.insertions[i], deletions=self.deletions[i])
+		commit.commit_timestamp = self.commit_timestamps[i]
+		if self.parents[i] is not None:
+			commit.parents = self.parents[i].split()
+		return commit
+
+	def __iter__(self) -> Iterator[CommitData]:
+		for i in range(len(self)):
+			yield self[i]
+
+	# Rows for `commit_cache` (tag, repo, commit_timestamp, insertions, deletions, commit_hash, author_name, author_email)
+	# without creating `CommitData`
+	def rows(self, tag:str, repo:str) -> Iterator[tuple]:
+		authors = [self.authors[author_id] for author_id in self.author_ids]
+		return zip(itertools.repeat(tag), itertools.repeat(repo), self.dates, self.insertions, self.deletions, self.hashes,
+				   (author.name for author in authors), (author.email for author in authors))
 
 def parse_datetime(date_string:str):
+	from dateutil import parser as date_parser
 
 	date = date_parser.parse(date_string)
 	return int(datetime.datetime.timestamp(date))
 
+# Dates printed using `--date=unix` are converted without `dateutil`. Any other format is parsed by `parse_datetime`.
+def parse_timestamp(date_string:str) -> int:
+	if date_string.isdigit():
+		return int(date_string)
+	return parse_datetime(date_string)
+
+# Append a (non-empty) line of a commit message. Used by both parsers so that they produce identical `CommitData`.
+def append_message_line(commit:CommitData, line:str):
+	line = line.strip()
+	if commit.message is None:
+		commit.message = line
+	else:
+		commit.message = commit.message + os.linesep + line
+
+	if 'merge' in commit.message or 'Merge' in commit.message:
+		commit.is_merge = True
+
+	change_id = CHANGE_ID_PATTERN.match(line)
+	if change_id:
+		commit.change_id = change_id.group(1)
+
 def get_output(command:str, base_path:str):
-	res_string = ""
-	with subprocess.Popen(command, stdout=Nonesubprocess.PIPE, stderr=None, shell=True, cwd=base_path) as process:
+	with subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=None, cwd=base_path) as process:
 		return process.communicate()[0].decode("utf-8").rstrip()
 
 class GitLogParser():
 
-	def __init__(self, repository_directory:str=".", last_hash:str=None, start_date:int=None):
+	def __init__(self, repository_directory:str=".", last_hash:str=None, start_date:int=None, worker_pool:gitparse_worker.GitWorkerPool=None):
 		self.commits = []
 		self.repository_directory = repository_directory
 		self.stop_at_hash = last_hash
 		self.start_date = start_date
+		self.worker_pool = worker_pool or gitparse_worker.shared_pool()
 
-	def mine_stats(self, commit_hash:str):
-		parent = subprocess.getoutput('git log --pretty=%P -1 ' + commit_hash)
-		return subprocess.getoutput('git diff ' + parent + ' ' + commit_hash + ' --shortstat')
+	# Dates are printed as unix timestamps, which `parse_date` converts without `dateutil`
+	@staticmethod
+	def command() -> List[str]:
+		return ['git', 'log', '--date=unix']
+
+	# Merges are diffed against their first parent
+	def mine_stats(self, commit_hash:str) -> gitparse_worker.DiffStat:
+		return self.worker_pool.diff_stats(self.repository_directory, commit_hash)
 
 	def parse_commit_hash(self, next_line:int, commit:CommitData):
 		# commit xxxx
 		if commit.commit_hash is not None:
-			# new commit, reset object
-			self.commits.append(copy.deepcopy(commit))
+			# new commit. `commit` is not modified after this, so it does not need to be copied.
+			self.commits.append(commit)
 			commit = CommitData()
-		commit.commit_hash = re.match('commit (.*)', next_line, re.IGNORECASE).group(1)
+		commit.commit_hash = COMMIT_LINE_PATTERN.match(next_line).group(1)
 
 		return commit
 
 	def parse_author(self, next_line:str):
-		m = re.compile('Author: (.*) <(.*)>').match(next_line)
-		return Author(m.group(1), m.group(2))
+		m = AUTHOR_LINE_PATTERN.match(next_line)
+		return AUTHORS.intern(m.group(1), m.group(2))
 
 	def parse_date(self, next_line:str, commit:str):
 		# Date: xxx
-		m = re.compile(r'Date:\s+(.*)$').match(next_line)
-		commit.date = parse_datetime(m.group(1))
+		m = DATE_LINE_PATTERN.match(next_line)
+		commit.date = parse_timestamp(m.group(1))
 
 	def parse_commit_msg(self, next_line:str, commit:CommitData):
 		# (4 empty spaces)
-		if commit.message is None:
-			commit.message = next_line.strip()
-		else:
-			commit.message = commit.message + os.linesep + next_line.strip()
-
-		if 'merge' in commit.message or 'Merge' in commit.message:
-			commit.is_merge = True
+		append_message_line(commit, next_line)
 
 	def parse_change_id(self, next_line:str, commit:CommitData):
-		commit.change_id = re.compile(r'    Change-Id:\s*(.*)').match(next_line).group(1)
+		commit.change_id = LEGACY_CHANGE_ID_PATTERN.match(next_line).group(1)
 
 	def parse_lines(self, raw_lines:List[str], commit:CommitData=None):
 		if commit is None:
 			commit = CommitData()
 		log.info("Parsing lines: %s", self.repository_directory)
 		for next_line in raw_lines.splitlines():
-			
+			# Line types are told apart by their (case insensitive) prefix
+			prefix = next_line[:7].lower()
+
 			if len(next_line.strip()) == 0:
 				# ignore empty lines
 				pass
 
-			elif bool(re.match('commit', next_line, re.IGNORECASE)):
+			elif prefix.startswith('commit'):
 				commit_orig = self.parse_commit_hash(next_line, commit)
 				if self.stop_at_hash is not None and commit_orig.commit_hash == self.stop_at_hash:
 					log.info("%s will stop at hash: %s", self.repository_directory,  self.stop_at_hash)
@@ -142,21 +291,21 @@ class GitLogParser():
 						return self.commits[-1]
 					else:
 						return None
-				commit = copy.deepcopy(commit_orig)
+				commit = commit_orig
 
-			elif bool(re.match('merge:', next_line, re.IGNORECASE)):
+			elif prefix.startswith('merge:'):
 				pass
 
-			elif bool(re.match('author:', next_line, re.IGNORECASE)):
+			elif prefix == 'author:':
 				commit.author = self.parse_author(next_line)
 
-			elif bool(re.match('date:', next_line, re.IGNORECASE)):
+			elif prefix.startswith('date:'):
 				self.parse_date(next_line, commit)
 
-			elif bool(re.match('    ', next_line, re.IGNORECASE)):
+			elif prefix.startswith('    '):
 				self.parse_commit_msg(next_line, commit)
 
-			elif bool(re.match('    change-id: ', next_line, re.IGNORECASE)):
+			elif next_line[:15].lower() == '    change-id: ':
 				self.parse_change_id(next_line, commit)
 			else:
 				log.exception("UnexpectedLineError(%s)", next_line)
@@ -165,7 +314,7 @@ class GitLogParser():
 				commit.ignore = True
 				
 		if len(self.commits) != 0 and not commit.ignore:
-			if not len(commit_orig.commit_hash ) == 40 or not bool(re.match(r'[a-z0-9]+', commit_orig.commit_hash)):
+			if not len(commit_orig.commit_hash ) == 40 or not bool(COMMIT_HASH_PATTERN.match(commit_orig.commit_hash)):
 				log.warning("Commit hash '%s' is not a valid hash. Ignoring.", commit.commit_hash)
 				commit.ignore = True
 			else:
@@ -174,72 +323,203 @@ class GitLogParser():
 		return commit
 
 	def update_stats(self):
+		log.info("%s Mining stats", self.repository_directory)
+		with gitstat_metrics.timer("mine_stats"):
+			for commit in self.commits:
+				stat = self.mine_stats(commit.commit_hash)
+				commit.files_changed = stat.files_changed
+				commit.insertions = stat.insertions
+				commit.deletions = stat.deletions
+				commit.total = commit.deletions + commit.insertions
+
+# Parses the output of a single `git log --shortstat` invocation (see `LOG_FORMAT`), which contains
+# hash, author, date, parents, message and diff stats for every commit. Replaces `GitLogParser.update_stats`,
+# which needed two subprocesses per commit.
+class GitLogStatParser():
+
+	# `oldest_first`: the log is in reverse topological order (see `iter_commits_oldest_first`), so it is not cut off
+	#                 at `last_hash` or `start_date`.
+	def __init__(self, repository_directory:str=".", last_hash:str=None, start_date:int=None, chunk_size:int=STREAM_CHUNK_SIZE, oldest_first:bool=False):
+		self.repository_directory = repository_directory
+		self.stop_at_hash = last_hash
+		self.start_date = start_date
+		self.chunk_size = chunk_size
+		self.oldest_first = oldest_first
+
+	# Only asks git for the commits that are new since `last_hash` and not older than `start_date`.
+	# `last_hash` must exist in the repository (see `has_commit`).
+	# Without `shortstat` git does not diff the commits, and their stats are 0.
+	# `oldest_first`: list parents before their children. `exclude`: more commits whose history is left out, like `last_hash`.
+	# `head`: the commit whose history is listed.
+	@staticmethod
+	def command(last_hash:str=None, start_date:int=None, shortstat:bool=True, oldest_first:bool=False, exclude:List[str]=None, head:str="HEAD") -> List[str]:
+		command = ['git', 'log', f'--format={LOG_FORMAT}']
+		if shortstat:
+			# Merges are diffed against their first parent, which is what `git show --stat` reports.
+			command = command + ['--shortstat', '--diff-merges=first-parent']
+		if oldest_first:
+			command = command + ['--topo-order', '--reverse']
+		if start_date:
+			command.append(f'--since=@{start_date}')
+		exclude = ([last_hash] if last_hash else []) + (exclude or [])
+		if exclude or head != "HEAD":
+			command = command + [head] + [f'^{commit_hash}' for commit_hash in exclude] + ['--']
+		return command
+
+	def parse_record(self, record:str) -> CommitData:
+		header, stat = record.rsplit(FIELD_SEPARATOR, 1)
+		commit_hash, parents, name, email, timestamp, commit_timestamp, body = header.split(FIELD_SEPARATOR, 6)
+		commit = CommitData(commit_hash=commit_hash, author=AUTHORS.intern(name, email), date=int(timestamp))
+		commit.parents = parents.split()
+		commit.commit_timestamp = int(commit_timestamp)
+		for line in body.splitlines():
+			if len(line.strip()) != 0:
+				append_message_line(commit, line)
+		diff_stat = gitparse_worker.parse_shortstat(stat.strip())
+		if diff_stat:
+			commit.files_changed = diff_stat.files_changed
+			commit.insertions = diff_stat.insertions
+			commit.deletions = diff_stat.deletions
+		return commit
 
-		cwd = os.getcwd()
-		os.chdir(self.repository_directory)
-
-		j = 0
+	# Split a stream of bytes into records without reading more than `chunk_size` bytes at a time
+	def read_records(self, stream) -> Iterator[str]:
+		decoder = codecs.getincrementaldecoder("utf8")('ignore')
+		pending = ""
+		while True:
+			chunk = stream.read(self.chunk_size)
+			gitstat_metrics.count("git.bytes_read", len(chunk))
+			pending = pending + decoder.decode(chunk, final=not chunk)
+			records = pending.split(RECORD_SEPARATOR)
+			pending = records.pop()
+			for record in records:
+				if len(record) != 0:
+					yield record
+			if not chunk:
+				break
+		if len(pending) != 0:
+			yield pending
+
+	# Yields commits until `last_hash` or a commit older than `start_date` is found.
+	def commits(self, records:Iterable[str]) -> Iterator[CommitData]:
+		log.info("Parsing log: %s", self.repository_directory)
+		for record in records:
+			commit = self.parse_record(record)
+			if self.stop_at_hash is not None and commit.commit_hash == self.stop_at_hash:
+				log.info("%s will stop at hash: %s", self.repository_directory,  self.stop_at_hash)
+				return
+			if self.start_date is not None and commit.date < self.start_date:
+				# `git log` is ordered by commit date; once that passes `start_date` only older history remains
+				if commit.commit_timestamp < self.start_date and not self.oldest_first:
+					log.info("%s will stop at date: %s", self.repository_directory, self.start_date)
+					return
+				continue
+			yield commit
+
+	def parse(self, raw_output:str) -> List[CommitData]:
+		return list(self.commits(record for record in raw_output.split(RECORD_SEPARATOR) if len(record) != 0))
+
+def has_commit(repository_directory, commit_hash:str) -> bool:
+	result = subprocess.run(['git', 'rev-parse', '--verify', '--quiet', f'{commit_hash}^{{commit}}'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=repository_directory)
+	gitstat_metrics.count("git.subprocesses")
+	return result.returncode == 0
+
+# The commit checked out in a repository, or None if it has no commits
+def head_hash(repository_directory) -> str:
+	result = subprocess.run(['git', 'rev-parse', '--verify', '--quiet', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=repository_directory)
+	gitstat_metrics.count("git.subprocesses")
+	if result.returncode != 0:
+		return None
+	return result.stdout.decode('utf8').strip()
+
+# Set the stats of `commits` from `known_stats` (see `iter_commits`), or by diffing the commits that are not known.
+def _resolve_stats(repository_directory, commits:List[CommitData], known_stats, worker_pool:gitparse_worker.GitWorkerPool) -> List[CommitData]:
+	known = known_stats([commit.commit_hash for commit in commits])
+	gitstat_metrics.count("git.commits_reused", len(known))
+	for commit in commits:
+		stat = known.get(commit.commit_hash)
+		if stat is None:
+			stat = worker_pool.diff_stats(repository_directory, commit.commit_hash)
+		commit.files_changed = stat.files_changed
+		commit.insertions = stat.insertions
+		commit.deletions = stat.deletions
+	return commits
+
+def _with_stats(repository_directory, commits:Iterator[CommitData], known_stats, worker_pool:gitparse_worker.GitWorkerPool) -> Iterator[CommitData]:
+	batch = []
+	for commit in commits:
+		batch.append(commit)
+		if len(batch) == STATS_LOOKUP_BATCH_SIZE:
+			yield from _resolve_stats(repository_directory, batch, known_stats, worker_pool)
+			batch = []
+	if len(batch) != 0:
+		yield from _resolve_stats(repository_directory, batch, known_stats, worker_pool)
+
+# Stream the commits of a repository, one `CommitData` at a time. The git process is terminated
+# as soon as the caller stops iterating or a cutoff (`last_hash`, `start_date`) is reached.
+#
+# `known_stats`: a function returning the stats (`gitparse_worker.DiffStat`) of the commits it knows among a list of hashes
+# (see `GitStatCache.known_stats`). git then lists the commits without diffing them, and only the unknown ones are
+# diffed (using `worker_pool`). This avoids diffing commits again that are shared with other repositories (forks, mirrors).
+def iter_commits(repository_directory, last_hash:str=None, start_date:int=None, known_stats=None, worker_pool:gitparse_worker.GitWorkerPool=None) -> Iterator[CommitData]:
+	parser = GitLogStatParser(repository_directory, last_hash, start_date)
+	range_hash = last_hash
+	if last_hash and not has_commit(repository_directory, last_hash):
+		# The cached hash is gone (force push, shallow clone); walk the history and stop at it if it shows up
+		log.warning(f"{repository_directory} does not contain {last_hash}. Reading the complete history.")
+		range_hash = None
+	yield from _stream_commits(repository_directory, parser, GitLogStatParser.command(range_hash, start_date, shortstat=known_stats is None), known_stats, worker_pool)
+
+# Stream the commits that are not in the history of `last_hash` or `cursor`, parents before their children (`--topo-order --reverse`).
+# Every commit yielded has all its (listed) ancestors yielded before it, so the history of the last commit that has been
+# processed can be used as a `cursor` to resume, even if the commits are not read to the end. Commits that are not in
+# its history (i.e. of other branches) are listed again after resuming. Hashes that are not in the repository are ignored.
+# git lists the commits once it has walked the whole range, so the first commit takes longer than with `iter_commits`.
+# `head`: the commit to stop at (see `head_hash`), so that commits made while reading are left for the next ingestion.
+def iter_commits_oldest_first(repository_directory, last_hash:str=None, start_date:int=None, cursor:str=None, head:str=None, known_stats=None,
+							  worker_pool:gitparse_worker.GitWorkerPool=None) -> Iterator[CommitData]:
+	exclude = [commit_hash for commit_hash in [last_hash, cursor] if commit_hash and has_commit(repository_directory, commit_hash)]
+	parser = GitLogStatParser(repository_directory, start_date=start_date, oldest_first=True)
+	command = GitLogStatParser.command(start_date=start_date, shortstat=known_stats is None, oldest_first=True, exclude=exclude, head=head or "HEAD")
+	yield from _stream_commits(repository_directory, parser, command, known_stats, worker_pool)
+
+def _stream_commits(repository_directory, parser:GitLogStatParser, command:List[str], known_stats, worker_pool:gitparse_worker.GitWorkerPool) -> Iterator[CommitData]:
+	process = subprocess.Popen(command, stdout=subprocess.PIPE, cwd=repository_directory)
+	gitstat_metrics.count("git.subprocesses")
+	commit_count = 0
+	commits = parser.commits(parser.read_records(process.stdout))
+	if known_stats is not None:
+		commits = _with_stats(repository_directory, commits, known_stats, worker_pool or gitparse_worker.shared_pool())
+	try:
+		for commit in commits:
+			commit_count = commit_count + 1
+			yield commit
+		# Unless the parser stopped at a cutoff, git has closed its output and its exit status tells if the log is complete.
+		# git is only terminated below, so a negative status means that it was killed by someone else (i.e. the OOM killer).
+		if process.stdout.read(1) == b'' and process.wait() != 0:
+			raise GitLogError(f"{repository_directory}: '{' '.join(command)}' exited with {process.returncode}")
+	finally:
+		gitstat_metrics.count("git.commits", commit_count)
+		if process.poll() is None:
+			process.terminate()
+		process.stdout.close()
+		process.wait()
+
+def get_commits(repository_directory, last_hash:int=None, start_date:int=None, single_pass:bool=True):
+	if single_pass:
 		try:
-			with concurrent.futures.ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
-				results = list()
-				
-				log.info("%s Mining stats", self.repository_directory)
-				for i in range(len(self.commits)-2, -1, -1):
-					results.append(executor.submit(self.mine_stats, self.commits[i].commit_hash))
-			
-				#this is needed since the commits are in a different order then the results
-				current_commit = len(self.commits) - 2
-			
-				log.info("%s Getting diff-data", self.repository_directory)
-				for r in results:
-#					j = j + 1
-#					if j % 100 == 0:
-#						print(f"{j}")
-					if self.commits[current_commit].is_merge:
-						resultList = r.result()
-						if len(resultList) < 3:
-							log.warning(f"Unable to parse diff data from merge: {self.commits[current_commit].commit_hash} in {self.repository_directory}")
-							continue
-						if not resultList[0] == ' ':
-							self.commits[current_commit].files_changed = int(resultList[0])
-						if not resultList[1] == ' ':
-							self.commits[current_commit].insertions = int(resultList[1])
-						if not resultList[2] == ' ':
-							self.commits[current_commit].deletions = int(resultList[2])
+			return list(iter_commits(repository_directory, last_hash, start_date))
+		except GitLogError as e:
+			log.error(f"{repository_directory} Git process error: {e}")
+			return []
 
-					else:
-						stat_dict = dict()
-						# since the result method stop the code until the thread finishes, we don't have to wait for the results to come in anywhere else
-						stats = r.result().split()
-						# since all 3 stats can be 0 in which case they are not displayed, this loop is needed to create a dict based on the existing ones
-						for j in range(1, len(stats)):
-							if stats[j-1].isdigit():
-								stat_dict[stats[j]] = int(stats[j-1])
-						#if a part of a statistic is missing the keys vary, but they always start the same way
-						for key in stat_dict:
-							if key.startswith('file'):
-								self.commits[current_commit].files_changed = int(stat_dict[key])
-
-							if key.startswith('insertion'):
-								self.commits[current_commit].insertions = int(stat_dict[key])
-
-							if key.startswith('deletion'):
-								self.commits[current_commit].deletions = int(stat_dict[key])
-
-							self.commits[current_commit].total = self.commits[current_commit].deletions + self.commits[current_commit].insertions 
-					current_commit = current_commit - 1
-		except:
-			os.chdir(cwd)
-			raise
-
-			os.chdir(cwd)
-
-def get_commits(repository_directory, last_hash:int=None, start_date:int=None):
 	try:
-		git_result = subprocess.check_output(['git', 'log'], cwd=repository_directory)
+		gitstat_metrics.count("git.subprocesses")
+		git_result = subprocess.check_output(GitLogParser.command(), cwd=repository_directory)
 	except subprocess.CalledProcessError as e:
 		log.error(f"{repository_directory} Git process error: {e}")
 		return []
+	gitstat_metrics.count("git.bytes_read", len(git_result))
 	decoded = git_result.decode("utf8", 'ignore')
 	parser = GitLogParser(repository_directory, last_hash, start_date)
 	parser.parse_lines(decoded)
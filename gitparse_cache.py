@@ -1,20 +1,154 @@
 import sqlite3
 import os
-from typing import List
+import json
+import threading
+from typing import List, Dict, Tuple, Iterator
 import logging
 
 from common import ensure_path
 import gitparse
+import gitparse_worker
+import gitstat_metrics
 from gitstat_models import *
 
 LOGGER_TAG = gitparse.GIT_PARSE_LOGGER_ID
 log = logging.getLogger(LOGGER_TAG)
 
+# Applied to every connection. WAL lets readers run while commits are inserted, and with WAL `synchronous=NORMAL`
+# only risks the latest transactions on power loss, never the integrity of the file.
+PRAGMAS = [
+	"PRAGMA journal_mode=WAL",
+	"PRAGMA synchronous=NORMAL",
+	"PRAGMA temp_store=MEMORY",
+	"PRAGMA cache_size=-65536",
+]
+
+# Schema migrations, applied in order. `PRAGMA user_version` holds the number of migrations applied to a db file.
+MIGRATIONS = [
+	# 1: Index for the tag filter (the indexes of `commit_cache` are created with its final schema, see 7)
+	[
+		"CREATE INDEX IF NOT EXISTS repo_mapping_tag ON repo_mapping(tag)",
+	],
+	# 2: Period sums per repository for the intervals in `ROLLUP_INTERVALS`, and a key/value store for cache state
+	[
+		"""CREATE TABLE IF NOT EXISTS commit_rollup (
+			tag TEXT,
+			repo TEXT,
+			period_interval INTEGER,
+			timestamp INTEGER,
+			commit_count INTEGER,
+			insertions INTEGER,
+			deletions INTEGER,
+			PRIMARY KEY(tag, period_interval, timestamp, repo)
+		) WITHOUT ROWID""",
+		"CREATE TABLE IF NOT EXISTS cache_settings(key TEXT PRIMARY KEY, value)",
+	],
+	# 3: Validators and bodies of metadata responses (see `gitstat_http.MetadataClient`)
+	[
+		"CREATE TABLE IF NOT EXISTS http_cache(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body TEXT)",
+	],
+	# 4: State of the last successful fetch of a repository (see `RepoMeta.pushed_at`)
+	[
+		"ALTER TABLE repo_mapping ADD COLUMN pushed_at TEXT",
+		"ALTER TABLE repo_mapping ADD COLUMN remote_head TEXT",
+	],
+	# 5: Stats of every known commit by hash, shared by all repositories containing it (forks, mirrors).
+	#    `commit_cache` lists the commits of each repository.
+	[
+		"""CREATE TABLE IF NOT EXISTS commit_store (
+			commit_hash TEXT PRIMARY KEY,
+			commit_timestamp INTEGER,
+			insertions INTEGER,
+			deletions INTEGER
+		) WITHOUT ROWID""",
+		"INSERT OR IGNORE INTO commit_store (commit_hash, commit_timestamp, insertions, deletions) SELECT commit_hash, commit_timestamp, insertions, deletions FROM commit_cache",
+	],
+	# 6: Progress of an unfinished ingestion (see `GitStatCache.checkpoint`)
+	[
+		"""CREATE TABLE IF NOT EXISTS ingest_cursor (
+			tag TEXT,
+			repo TEXT,
+			commit_hash TEXT,
+			commit_count INTEGER,
+			PRIMARY KEY(tag, repo)
+		) WITHOUT ROWID""",
+	],
+	# 7: Commit authors, and repositories with the same name in different tags (forks, mirrors): commits are unique per
+	#    (tag, repo) instead of per repo name, and repo_mapping loses UNIQUE(repo_name, last_commit_hash). SQLite cannot
+	#    drop constraints, so both tables are rebuilt. Commits inserted before have no author.
+	#    The (tag, repo, timestamp) index covers the period sums and the arrays of the time-range queries (see
+	#    `GitStatCache.query_aggregates`), the author index only selects the rows.
+	[
+		"""CREATE TABLE commit_cache_rebuilt (
+			id INTEGER PRIMARY KEY,
+			tag TEXT,
+			repo TEXT,
+			commit_timestamp INTEGER,
+			insertions INTEGER,
+			deletions INTEGER,
+			commit_hash TEXT,
+			author_name TEXT,
+			author_email TEXT,
+			UNIQUE(tag, repo, commit_hash)
+		)""",
+		"""INSERT INTO commit_cache_rebuilt (id, tag, repo, commit_timestamp, insertions, deletions, commit_hash)
+			SELECT id, tag, repo, commit_timestamp, insertions, deletions, commit_hash FROM commit_cache""",
+		"DROP TABLE commit_cache",
+		"ALTER TABLE commit_cache_rebuilt RENAME TO commit_cache",
+		"CREATE INDEX commit_cache_tag_repo_timestamp_stats ON commit_cache(tag, repo, commit_timestamp, insertions, deletions)",
+		"CREATE INDEX commit_cache_tag_author_timestamp ON commit_cache(tag, author_email, commit_timestamp)",
+		"""CREATE TABLE repo_mapping_rebuilt (
+			id INTEGER PRIMARY KEY,
+			repo_id INTEGER UNIQUE,
+			repo_name TEXT,
+			default_branch TEXT,
+			url TEXT UNIQUE,
+			stars INTEGER,
+			forks INTEGER,
+			size INTEGER,
+			tag TEXT,
+			is_cloned BOOL,
+			failed INTEGER,
+			last_commit_hash TEXT,
+			pushed_at TEXT,
+			remote_head TEXT
+		)""",
+		"""INSERT INTO repo_mapping_rebuilt (id, repo_id, repo_name, default_branch, url, stars, forks, size, tag, is_cloned, failed, last_commit_hash, pushed_at, remote_head)
+			SELECT id, repo_id, repo_name, default_branch, url, stars, forks, size, tag, is_cloned, failed, last_commit_hash, pushed_at, remote_head FROM repo_mapping""",
+		"DROP TABLE repo_mapping",
+		"ALTER TABLE repo_mapping_rebuilt RENAME TO repo_mapping",
+		"CREATE INDEX repo_mapping_tag ON repo_mapping(tag)",
+	],
+]
+
+# Adds the sums of new commits to existing rollup rows
+ROLLUP_UPSERT = """INSERT INTO commit_rollup (tag, repo, period_interval, timestamp, commit_count, insertions, deletions) VALUES (?, ?, ?, ?, ?, ?, ?)
+	ON CONFLICT(tag, period_interval, timestamp, repo) DO UPDATE SET
+		commit_count=commit_count + excluded.commit_count,
+		insertions=insertions + excluded.insertions,
+		deletions=deletions + excluded.deletions"""
+
+# Number of rows passed to each `executemany`
+INSERT_BATCH_SIZE = 1000
+
+def _stored_stats(db:sqlite3.Connection, commit_hashes:List[str]) -> Dict[str, gitparse_worker.DiffStat]:
+	rows = db.execute("SELECT commit_hash, insertions, deletions FROM commit_store WHERE commit_hash IN (SELECT value FROM json_each(?))", (json.dumps(commit_hashes),))
+	return {commit_hash: gitparse_worker.DiffStat(0, insertions, deletions) for (commit_hash, insertions, deletions) in rows}
+
+# Looks up the stats of known commits (see `GitStatCache.known_stats`) using its own read-only connection,
+# so that it can be used by the ingestion worker processes while the cache is written.
+class CommitStatsReader:
+
+	def __init__(self, db_path:str):
+		self.db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+
+	def __call__(self, commit_hashes:List[str]) -> Dict[str, gitparse_worker.DiffStat]:
+		return _stored_stats(self.db, commit_hashes)
+
 class GitStatCache:
 	def __init__(self, config:GitStatConfig, db_file_name:str="git_stat_cache.db"):
 		self.config = config
 		self.db_file_name = db_file_name
-		self.cwd = os.getcwd()
 		self.create_db()
 
 	@property
@@ -24,7 +158,11 @@ class GitStatCache:
 	def create_db(self):
 		ensure_path(self.config.cache_path)
 		log.info(f"Using cache db file: '{self.db_path}'")
-		self.db = sqlite3.connect(self.db_path)
+		# The connection is shared with the metadata threads (see `load_http_response`), which serialize their access with `lock`
+		self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+		self.lock = threading.RLock()
+		for pragma in PRAGMAS:
+			self.db.execute(pragma)
 		self.db_cursor = self.db.cursor()
 		self.db_cursor.execute("CREATE TABLE IF NOT EXISTS commit_cache(id INTEGER PRIMARY KEY, tag TEXT, repo TEXT, commit_timestamp INTEGER, insertions INTEGER, deletions INTEGER, commit_hash TEXT, UNIQUE(repo, commit_hash))")
 		self.db_cursor.execute('''CREATE TABLE IF NOT EXISTS repo_mapping (
@@ -42,49 +180,297 @@ class GitStatCache:
                 last_commit_hash TEXT,
                 UNIQUE(repo_name, last_commit_hash)
             )''')
+		self.migrate()
+		self.ensure_rollups()
+
+	@property
+	def schema_version(self) -> int:
+		return self.db.execute("PRAGMA user_version").fetchone()[0]
+
+	# Bring an existing db file up to date. Every migration runs in its own transaction.
+	def migrate(self):
+		version = self.schema_version
+		for (i, migration) in enumerate(MIGRATIONS[version:]):
+			log.info(f"Migrating '{self.db_path}' to schema version {version + i + 1}")
+			with self.db:
+				for statement in migration:
+					if callable(statement):
+						statement(self.db)
+					else:
+						self.db.execute(statement)
+				self.db.execute(f"PRAGMA user_version={version + i + 1}")
 
 	def load_meta(self, repo_meta:RepoMeta) -> RepoMeta:
-		cached_repo_meta = self.db_cursor.execute(f"SELECT * FROM repo_mapping WHERE repo_id={repo_meta.id}").fetchone()
+		cached_repo_meta = self.db_cursor.execute("SELECT * FROM repo_mapping WHERE repo_id=?", (repo_meta.id,)).fetchone()
 		if cached_repo_meta:
 			return RepoMeta(db_row=cached_repo_meta)
 		return repo_meta
 
 	def load_metas(self, repo_mapping:RepoMapping) -> List[RepoMeta]:
-		for row in self.db_cursor.execute(f"SELECT * FROM repo_mapping WHERE tag=\"{repo_mapping.tag}\"").fetchall():
+		for row in self.db_cursor.execute("SELECT * FROM repo_mapping WHERE tag=?", (repo_mapping.tag,)).fetchall():
 			yield RepoMeta(db_row=row)
 
 	def update_meta(self, repo_meta:RepoMeta):
-		cached = self.db_cursor.execute(f"SELECT * FROM repo_mapping WHERE repo_id={repo_meta.id}").fetchone()
+		cached = self.db_cursor.execute("SELECT * FROM repo_mapping WHERE repo_id=?", (repo_meta.id,)).fetchone()
 		if cached:
-			self.db_cursor.execute(f"UPDATE repo_mapping SET last_commit_hash=\"{repo_meta.last_commit_hash}\" WHERE repo_id={repo_meta.id}")
+			self.db_cursor.execute("UPDATE repo_mapping SET last_commit_hash=? WHERE repo_id=?", (repo_meta.last_commit_hash, repo_meta.id))
+		else:
+			self.db_cursor.execute("INSERT INTO repo_mapping (repo_id, repo_name, default_branch, url, stars, forks, size, tag, is_cloned, failed, last_commit_hash, pushed_at, remote_head) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+				(repo_meta.id, repo_meta.repo_name, repo_meta.default_branch, repo_meta.url, repo_meta.stars, repo_meta.forks, repo_meta.size, repo_meta.tag, repo_meta.is_cloned, repo_meta.failed, repo_meta.last_commit_hash, repo_meta.pushed_at, repo_meta.remote_head))
+
+	# Store `pushed_at` and `remote_head` after `repo_meta` has been fetched
+	def update_fetch_state(self, repo_meta:RepoMeta):
+		if self.db_cursor.execute("SELECT id FROM repo_mapping WHERE repo_id=?", (repo_meta.id,)).fetchone():
+			self.db_cursor.execute("UPDATE repo_mapping SET pushed_at=?, remote_head=? WHERE repo_id=?", (repo_meta.pushed_at, repo_meta.remote_head, repo_meta.id))
 		else:
-			last_commit_hash_str = "NULL"
-			if repo_meta.last_commit_hash:
-				last_commit_hash_str = f"\"{repo_meta.last_commit_hash}\""
-			sql = "INSERT INTO repo_mapping (repo_id, repo_name, default_branch, url, stars, forks, size, tag, is_cloned, failed, last_commit_hash) VALUES " + f"({repo_meta.id}, \"{repo_meta.repo_name}\", \"{repo_meta.default_branch}\", \"{repo_meta.url}\",  {repo_meta.stars}, {repo_meta.forks}, {repo_meta.size}, \"{repo_meta.tag}\", {repo_meta.is_cloned}, {repo_meta.failed}, {last_commit_hash_str})"
-			self.db_cursor.execute(sql)
-
-	def update_commits(self, repo_meta:RepoMeta) -> str:
-		last_commit_hash = None
-		os.chdir(self.cwd)
-		for commit in gitparse.get_commits(self.config.repo_directory(repo_meta), last_hash=repo_meta.last_commit_hash, start_date=self.config.max_history_time):
-
-			if not last_commit_hash:
-				last_commit_hash = commit.commit_hash
+			self.update_meta(repo_meta)
+		self.db.commit()
+
+	# Store `failed`, the number of failed refreshes in a row (see `GitStatDaemon.refresh_interval`)
+	def update_failed(self, repo_meta:RepoMeta):
+		if self.db_cursor.execute("SELECT id FROM repo_mapping WHERE repo_id=?", (repo_meta.id,)).fetchone():
+			self.db_cursor.execute("UPDATE repo_mapping SET failed=? WHERE repo_id=?", (repo_meta.failed, repo_meta.id))
+		else:
+			self.update_meta(repo_meta)
+		self.db.commit()
+
+	def get_setting(self, key:str, default=None):
+		row = self.db.execute("SELECT value FROM cache_settings WHERE key=?", (key,)).fetchone()
+		return row[0] if row else default
+
+	def set_setting(self, key:str, value):
+		self.db.execute("INSERT OR REPLACE INTO cache_settings (key, value) VALUES (?, ?)", (key, value))
+
+	# The rollups contain all commits, whatever the `max_history_time` of the processes sharing the db file; the start of a
+	# query is applied when it is read (see `query_aggregates`). Files written by earlier versions had rollups starting at
+	# `max_history_time` ("rollup_start"), and are rebuilt once.
+	def ensure_rollups(self):
+		if self.get_setting("rollup_start") != 0:
+			log.info(f"Building rollups in '{self.db_path}'")
+			with self.db:
+				self.rebuild_rollups()
+				self.set_setting("rollup_start", 0)
+
+	# Recompute the rollups from `commit_cache`
+	def rebuild_rollups(self):
+		self.db.execute("DELETE FROM commit_rollup")
+		for interval in ROLLUP_INTERVALS.values():
+			self.db.execute("INSERT INTO commit_rollup (tag, repo, period_interval, timestamp, commit_count, insertions, deletions) "
+				f"SELECT tag, repo, {interval}, (commit_timestamp / {interval} + 1) * {interval} AS period, COUNT(*), SUM(insertions), SUM(deletions) "
+				"FROM commit_cache GROUP BY tag, repo, period")
+
+	# Add commit rows (as inserted into `commit_cache`) to the buckets of every rollup interval
+	def _update_rollups(self, rows:List[tuple]):
+		for interval in ROLLUP_INTERVALS.values():
+			buckets = dict()
+			for (tag, repo, timestamp, insertions, deletions, *_) in rows:
+				key = (tag, repo, interval, (timestamp // interval + 1) * interval)
+				commit_count, insertion_sum, deletion_sum = buckets.get(key, (0, 0, 0))
+				buckets[key] = (commit_count + 1, insertion_sum + insertions, deletion_sum + deletions)
+			self.db_cursor.executemany(ROLLUP_UPSERT, [key + sums for (key, sums) in buckets.items()])
+
+	# Returns (etag, last_modified, body) of the last response stored for `url`
+	def load_http_response(self, url:str) -> tuple:
+		with self.lock:
+			return self.db.execute("SELECT etag, last_modified, body FROM http_cache WHERE url=?", (url,)).fetchone()
+
+	def store_http_response(self, url:str, etag:str, last_modified:str, body:str):
+		with self.lock, self.db:
+			self.db.execute("INSERT OR REPLACE INTO http_cache (url, etag, last_modified, body) VALUES (?, ?, ?, ?)", (url, etag, last_modified, body))
+
+	def _insert_commit_rows(self, repo_meta:RepoMeta, rows:List[tuple]):
+		with gitstat_metrics.timer("cache.insert"):
 			try:
-				self.db_cursor.execute("INSERT INTO commit_cache (tag, repo, commit_timestamp, insertions, deletions, commit_hash) VALUES (?, ?, ?, ?, ?, ?)",
-					(repo_meta.tag, repo_meta.repo_name, commit.date, commit.insertions, commit.deletions, commit.commit_hash))
+				self.db_cursor.executemany("INSERT INTO commit_cache (tag, repo, commit_timestamp, insertions, deletions, commit_hash, author_name, author_email) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
 			except sqlite3.IntegrityError as e:
-				log.error(f"IntegrityError for {repo_meta.tag} {repo_meta.repo_name}. Hash: {commit.commit_hash}")
+				log.error(f"IntegrityError for {repo_meta.tag} {repo_meta.repo_name}. Hashes: {rows[0][5]}...{rows[-1][5]}")
 				raise e
-		if last_commit_hash and repo_meta.last_commit_hash != last_commit_hash:
-			repo_meta.last_commit_hash = last_commit_hash
+			self.db_cursor.executemany("INSERT OR IGNORE INTO commit_store (commit_hash, commit_timestamp, insertions, deletions) VALUES (?, ?, ?, ?)",
+									   ((row[5], row[2], row[3], row[4]) for row in rows))
+			self._update_rollups(rows)
+		gitstat_metrics.count("cache.rows_inserted", len(rows), gitstat_metrics.repo_label(repo_meta))
+
+	# The stats of the commits in `commit_hashes` that have been stored before, by any repository. Used with `gitparse.iter_commits`
+	# to reuse the stats of commits shared by forks and mirrors. `files_changed` is not stored and always 0.
+	def known_stats(self, commit_hashes:List[str]) -> Dict[str, gitparse_worker.DiffStat]:
+		with self.lock:
+			return _stored_stats(self.db, commit_hashes)
+
+	# The `commit_timestamp` of the newest commit of `repo_meta` in the cache
+	def last_commit_timestamp(self, repo_meta:RepoMeta) -> int:
+		return self.db.execute("SELECT MAX(commit_timestamp) FROM commit_cache WHERE tag=? AND repo=?", (repo_meta.tag, repo_meta.repo_name)).fetchone()[0]
+
+	# The highest row id in `commit_cache`. Rows inserted later have higher ids (see `earliest_commit_since`).
+	def commit_watermark(self) -> int:
+		return self.db_cursor.execute("SELECT COALESCE(MAX(id), 0) FROM commit_cache").fetchone()[0]
+
+	# Resumable ingestion: the commits are read oldest first (see `gitparse.iter_commits_oldest_first`) and every batch is
+	# committed with a cursor, the last commit of the batch. An interrupted ingestion continues after the cursor, and
+	# `complete_ingest` moves `last_commit_hash` once the repository has been read to the end.
+
+	# The cursor of an unfinished ingestion of `repo_meta`, or None
+	def load_cursor(self, repo_meta:RepoMeta) -> str:
+		row = self.db.execute("SELECT commit_hash FROM ingest_cursor WHERE tag=? AND repo=?", (repo_meta.tag, repo_meta.repo_name)).fetchone()
+		return row[0] if row else None
+
+	# Insert a batch of commits (oldest first), move the cursor to its last commit and commit the transaction.
+	# Commits already in the cache for `repo_meta` are skipped: after resuming, git lists the commits of merged branches
+	# that are not ancestors of the cursor again. Returns the number of commits inserted.
+	def checkpoint(self, repo_meta:RepoMeta, commits:gitparse.CommitBatch) -> int:
+		if len(commits) == 0:
+			return 0
+		existing = set(row[0] for row in self.db.execute("SELECT commit_hash FROM commit_cache WHERE tag=? AND repo=? AND commit_hash IN (SELECT value FROM json_each(?))",
+														  (repo_meta.tag, repo_meta.repo_name, json.dumps(commits.hashes))))
+		rows = [row for row in commits.rows(repo_meta.tag, repo_meta.repo_name) if row[5] not in existing]
+		for i in range(0, len(rows), INSERT_BATCH_SIZE):
+			self._insert_commit_rows(repo_meta, rows[i:i + INSERT_BATCH_SIZE])
+		self.db_cursor.execute("""INSERT INTO ingest_cursor (tag, repo, commit_hash, commit_count) VALUES (?, ?, ?, ?)
+			ON CONFLICT(tag, repo) DO UPDATE SET commit_hash=excluded.commit_hash, commit_count=commit_count + excluded.commit_count""",
+			(repo_meta.tag, repo_meta.repo_name, commits.hashes[-1], len(rows)))
+		self.db.commit()
+		commit_count = self.db.execute("SELECT commit_count FROM ingest_cursor WHERE tag=? AND repo=?", (repo_meta.tag, repo_meta.repo_name)).fetchone()[0]
+		gitstat_metrics.count("cache.checkpoints", 1, gitstat_metrics.repo_label(repo_meta))
+		log.info(f"{repo_meta.tag} {repo_meta.repo_name}: {commit_count} commits ingested")
+		return len(rows)
+
+	# Store `head` (the commit the ingestion read up to) as the most recent commit of `repo_meta`, remove its cursor and
+	# commit the transaction.
+	def complete_ingest(self, repo_meta:RepoMeta, head:str):
+		if head and repo_meta.last_commit_hash != head:
+			repo_meta.last_commit_hash = head
 			self.update_meta(repo_meta)
+		self.db_cursor.execute("DELETE FROM ingest_cursor WHERE tag=? AND repo=?", (repo_meta.tag, repo_meta.repo_name))
 		self.db.commit()
-		os.chdir(self.cwd)
-		return last_commit_hash
+
+	# Time-range queries on the cached commits. They only read `commit_cache` (a `synchronize` is not needed) and select the
+	# commits using its indexes (see migration 7). `start` is inclusive and `end` exclusive (unix timestamps). `authors` filters by author
+	# e-mail; commits inserted before schema version 7 have no author and never match.
+
+	# The WHERE clause and its parameters for the commits of `tag` in [`start`, `end`)
+	@staticmethod
+	def _range_condition(tag:str, start:int=None, end:int=None, repo_names:List[str]=None, authors:List[str]=None) -> Tuple[str, list]:
+		condition = "tag=?"
+		parameters = [tag]
+		if repo_names is not None:
+			condition = condition + " AND repo IN (SELECT value FROM json_each(?))"
+			parameters.append(json.dumps(list(repo_names)))
+		if authors is not None:
+			condition = condition + " AND author_email IN (SELECT value FROM json_each(?))"
+			parameters.append(json.dumps(list(authors)))
+		if start:
+			condition = condition + " AND commit_timestamp >= ?"
+			parameters.append(start)
+		if end is not None:
+			condition = condition + " AND commit_timestamp < ?"
+			parameters.append(end)
+		return condition, parameters
+
+	# Stream the commits of `tag` in [`start`, `end`) as (repo name, `gitparse.CommitData`), oldest first.
+	# `CommitData.author` is set; messages and parents are not stored.
+	def query_commits(self, tag:str, start:int=None, end:int=None, repo_names:List[str]=None, authors:List[str]=None) -> Iterator[Tuple[str, gitparse.CommitData]]:
+		condition, parameters = self._range_condition(tag, start, end, repo_names, authors)
+		# The rows are selected using the author or the (tag, repo, timestamp) index. Without the hint, the planner may prefer
+		# the UNIQUE(tag, repo, commit_hash) index, which does not contain the timestamps.
+		index = "commit_cache_tag_author_timestamp" if authors is not None else "commit_cache_tag_repo_timestamp_stats"
+		sql = (f"SELECT id, tag, repo, commit_timestamp, insertions, deletions, commit_hash, author_name, author_email FROM commit_cache INDEXED BY {index} "
+			   f"WHERE {condition} ORDER BY commit_timestamp")
+		# A separate cursor, like `get_commits`
+		for row in self.db.execute(sql, parameters):
+			yield row[2], gitparse.CommitData(db_row=row)
+
+	# Stream `commit_timestamp`, `insertions` and `deletions` of the commits of `tag` in [`start`, `end`) as three int64 NumPy
+	# arrays per batch of at most `batch_size` commits (in no particular order).
+	def query_commit_arrays(self, tag:str, start:int=None, end:int=None, repo_names:List[str]=None, authors:List[str]=None, batch_size:int=100000):
+		import numpy as np
+
+		condition, parameters = self._range_condition(tag, start, end, repo_names, authors)
+		cursor = self.db.execute(f"SELECT commit_timestamp, insertions, deletions FROM commit_cache WHERE {condition}", parameters)
+		while True:
+			rows = cursor.fetchmany(batch_size)
+			if not rows:
+				return
+			columns = np.array(rows, dtype=np.int64)
+			yield columns[:, 0], columns[:, 1], columns[:, 2]
+
+	# Stream the sums of the commits of `tag` in [`start`, `end`) per period of `period_interval` seconds, oldest first.
+	# The timestamp of an entry is the end of its period, like `GitStats.calculate_timestamp`.
+	# Standard intervals (see `ROLLUP_INTERVALS`) are read from the rollups when `end` is the end of a period and `authors` is
+	# not used. If `start` is within a period, the commits of that period are summed from `commit_cache`.
+	# `distinct`: count commits that are shared by several repositories of `tag` (forks, mirrors) once.
+	def query_aggregates(self, period_interval:int, tag:str, start:int=None, end:int=None, repo_names:List[str]=None, authors:List[str]=None,
+						 distinct:bool=False) -> Iterator[GitStatEntry]:
+		rollup = self.has_rollup(period_interval) and not distinct and authors is None and (end is None or end % period_interval == 0)
+		if rollup:
+			sql = "SELECT timestamp AS period, commit_count, insertions, deletions FROM commit_rollup WHERE tag=? AND period_interval=?"
+			parameters = [tag, period_interval]
+			if repo_names is not None:
+				sql = sql + " AND repo IN (SELECT value FROM json_each(?))"
+				parameters.append(json.dumps(list(repo_names)))
+			if end is not None:
+				sql = sql + " AND timestamp <= ?"
+				parameters.append(end)
+			if start:
+				# The periods starting at or after `start`, and the commits since `start` in the period containing it
+				first_period = -(-start // period_interval) * period_interval
+				sql = sql + " AND timestamp > ?"
+				parameters.append(first_period)
+				if first_period != start:
+					condition, partial_parameters = self._range_condition(tag, start, first_period, repo_names)
+					sql = (f"{sql} UNION ALL SELECT (commit_timestamp / ? + 1) * ?, 1, insertions, deletions FROM commit_cache WHERE {condition}")
+					parameters = parameters + [period_interval, period_interval] + partial_parameters
+			sql = f"SELECT period, SUM(commit_count), SUM(insertions), SUM(deletions) FROM ({sql})"
+		else:
+			columns = "commit_timestamp, insertions, deletions"
+			if distinct:
+				columns = "MIN(commit_timestamp) AS commit_timestamp, MIN(insertions) AS insertions, MIN(deletions) AS deletions"
+			condition, parameters = self._range_condition(tag, start, end, repo_names, authors)
+			sql = f"SELECT {columns} FROM commit_cache WHERE {condition}"
+			if distinct:
+				sql = sql + " GROUP BY commit_hash"
+			sql = f"SELECT (commit_timestamp / ? + 1) * ? AS period, COUNT(*), SUM(insertions), SUM(deletions) FROM ({sql})"
+			parameters = [period_interval, period_interval] + parameters
+		sql = sql + " GROUP BY period ORDER BY period"
+		for (timestamp, commit_count, insertions, deletions) in self.db.execute(sql, parameters):
+			yield GitStatEntry(timestamp=timestamp,
+							   period_interval=period_interval,
+							   change_count=insertions + deletions,
+							   commit_count=commit_count,
+							   insertions=insertions,
+							   deletions=deletions)
+
+	# Sum the commits of `tag` (optionally only `repo_names`) per period of `period_interval` seconds, ignoring commits before
+	# `start` (see `query_aggregates`).
+	def aggregate_commits(self, period_interval:int, tag:str, repo_names:List[str]=None, start:int=None, distinct:bool=False) -> List[GitStatEntry]:
+		with gitstat_metrics.timer("cache.aggregate"):
+			return list(self.query_aggregates(period_interval, tag, start, repo_names=repo_names, distinct=distinct))
+
+	def has_rollup(self, period_interval:int) -> bool:
+		return period_interval in ROLLUP_INTERVALS.values()
+
+	# Load the rollup of `tag` for `period_interval` as four int64 NumPy arrays: timestamp, commit_count, insertions and deletions.
+	# `since` skips the periods that ended before it.
+	def rollup_arrays(self, period_interval:int, tag:str, repo_names:List[str]=None, since:int=None):
+		import numpy as np
+
+		entries = self.aggregate_commits(period_interval, tag, repo_names, self.config.max_history_time)
+		if since is not None:
+			entries = [entry for entry in entries if entry.timestamp > since]
+		columns = np.array([(entry.timestamp, entry.commit_count, entry.insertions, entry.deletions) for entry in entries], dtype=np.int64).reshape(-1, 4)
+		return columns[:, 0], columns[:, 1], columns[:, 2], columns[:, 3]
+
+	# Load `commit_timestamp`, `insertions` and `deletions` of the commits of `tag` as three int64 NumPy arrays.
+	def commit_arrays(self, tag:str, repo_names:List[str]=None, start:int=None, batch_size:int=100000):
+		import numpy as np
+
+		batches = [(np.empty(0, dtype=np.int64),) * 3] + list(self.query_commit_arrays(tag, start, repo_names=repo_names, batch_size=batch_size))
+		return tuple(np.concatenate([batch[i] for batch in batches]) for i in range(3))
+
+	# The earliest `commit_timestamp` (not before `start`) of the commits of `tag` inserted after `watermark` (see `commit_watermark`)
+	def earliest_commit_since(self, tag:str, repo_names:List[str], watermark:int, start:int=None) -> int:
+		return self.db.execute("SELECT MIN(commit_timestamp) FROM commit_cache WHERE tag=? AND id>? AND commit_timestamp>=? AND repo IN (SELECT value FROM json_each(?))",
+			(tag, watermark, start or 0, json.dumps(list(repo_names)))).fetchone()[0]
 
 	def get_commits(self, repo_meta:RepoMeta) -> List[gitparse.CommitData]:
-		self.db_cursor.execute(f"SELECT * FROM commit_cache WHERE tag=\"{repo_meta.tag}\" AND repo=\"{repo_meta.repo_name}\"")
-		for row in self.db_cursor.fetchall():
+		# A separate cursor, so that the rows are streamed even if `db_cursor` is used while iterating
+		for row in self.db.execute("SELECT * FROM commit_cache WHERE tag=? AND repo=?", (repo_meta.tag, repo_meta.repo_name)):
 			yield gitparse.CommitData(db_row=row)
\ No newline at end of file
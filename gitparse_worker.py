@@ -0,0 +1,194 @@
+import os
+import re
+import subprocess
+import threading
+import queue
+from contextlib import contextmanager
+from typing import List
+import logging
+
+from common import GIT_PARSE_LOGGER_ID
+import gitstat_metrics
+
+log = logging.getLogger(GIT_PARSE_LOGGER_ID)
+
+SHORTSTAT_PATTERN = re.compile(r'\s*(\d+) files? changed(?:, (\d+) insertions?\(\+\))?(?:, (\d+) deletions?\(-\))?')
+
+# Written after every `git diff-tree --stdin` request. It is not an object name, so git echoes it verbatim,
+# which marks the end of the response.
+DIFF_TREE_END_MARKER = "#gitstat-end"
+
+class GitWorkerError(Exception):
+	pass
+
+class GitObject:
+
+	def __init__(self, object_hash:str, object_type:str, size:int, content:bytes):
+		self.object_hash = object_hash
+		self.object_type = object_type
+		self.size = size
+		self.content = content
+
+	def __str__(self):
+		return f"{self.object_hash} {self.object_type} {self.size}"
+
+class DiffStat:
+
+	def __init__(self, files_changed:int=0, insertions:int=0, deletions:int=0):
+		self.files_changed = files_changed
+		self.insertions = insertions
+		self.deletions = deletions
+
+	def __eq__(self, other):
+		return (self.files_changed == other.files_changed
+			and self.insertions == other.insertions
+			and self.deletions == other.deletions)
+
+	def __str__(self):
+		return f"{self.files_changed}, {self.insertions}, {self.deletions}"
+
+# Parse a `--shortstat` line (" 2 files changed, 3 insertions(+), 1 deletion(-)"). Returns None for other lines.
+def parse_shortstat(line:str) -> DiffStat:
+	m = SHORTSTAT_PATTERN.match(line)
+	if not m:
+		return None
+	return DiffStat(int(m.group(1)), int(m.group(2) or 0), int(m.group(3) or 0))
+
+# A long-lived git process for a repository that answers one request at a time over stdin/stdout.
+class GitWorker:
+
+	def __init__(self, repository_directory:str, command:List[str]):
+		self.repository_directory = repository_directory
+		self.command = command
+		self.process = None
+
+	def start(self):
+		if self.process is None or self.process.poll() is not None:
+			self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=self.repository_directory)
+			gitstat_metrics.count("git.subprocesses")
+
+	def write(self, line:str):
+		self.start()
+		self.process.stdin.write(line.encode("utf8") + b"\n")
+		self.process.stdin.flush()
+
+	def read_line(self) -> str:
+		line = self.process.stdout.readline()
+		gitstat_metrics.count("git.bytes_read", len(line))
+		if not line:
+			raise GitWorkerError(f"{self.repository_directory}: '{' '.join(self.command)}' exited with {self.process.poll()}")
+		return line.decode("utf8", 'ignore').rstrip("\n")
+
+	def close(self):
+		if self.process is None:
+			return
+		if self.process.poll() is None:
+			self.process.stdin.close()
+			try:
+				self.process.wait(timeout=5)
+			except subprocess.TimeoutExpired:
+				self.process.kill()
+				self.process.wait()
+		self.process.stdout.close()
+		self.process = None
+
+# `git cat-file --batch`: returns the raw content of objects
+class CatFileWorker(GitWorker):
+
+	def __init__(self, repository_directory:str):
+		super().__init__(repository_directory, ['git', 'cat-file', '--batch'])
+
+	def get(self, object_name:str) -> GitObject:
+		self.write(object_name)
+		header = self.read_line()
+		if header.endswith(" missing") or header.endswith(" ambiguous"):
+			return None
+		object_hash, object_type, size = header.split(" ")
+		size = int(size)
+		content = self.process.stdout.read(size + 1)[:size]
+		gitstat_metrics.count("git.bytes_read", size + 1)
+		return GitObject(object_hash, object_type, size, content)
+
+# `git diff-tree --stdin --shortstat`: returns the diff stats of commits. Renames are detected (`-M`), like `git log` does by default.
+class DiffTreeWorker(GitWorker):
+
+	def __init__(self, repository_directory:str):
+		super().__init__(repository_directory, ['git', 'diff-tree', '--stdin', '--root', '-r', '-M', '--shortstat', '--diff-merges=first-parent'])
+
+	# Diff `commit_hash` against `parent`, or against its first parent (root commits against the empty tree).
+	def get(self, commit_hash:str, parent:str=None) -> DiffStat:
+		if parent:
+			self.write(f"{commit_hash} {parent}")
+		else:
+			self.write(commit_hash)
+		self.write(DIFF_TREE_END_MARKER)
+		stat = DiffStat()
+		while True:
+			line = self.read_line()
+			if line == DIFF_TREE_END_MARKER:
+				return stat
+			stat = parse_shortstat(line) or stat
+
+# Keeps up to `workers_per_repository` processes of every worker type alive for each repository.
+# Workers are handed out to one thread at a time and returned to the pool afterwards.
+class GitWorkerPool:
+
+	def __init__(self, workers_per_repository:int=1):
+		self.workers_per_repository = workers_per_repository
+		self._lock = threading.Lock()
+		self._idle = dict()
+		self._all = dict()
+
+	@contextmanager
+	def worker(self, worker_type:type, repository_directory:str):
+		key = (worker_type, os.path.abspath(repository_directory))
+		with self._lock:
+			if key not in self._idle:
+				self._idle[key] = queue.Queue()
+				self._all[key] = []
+			idle = self._idle[key]
+			if idle.empty() and len(self._all[key]) < self.workers_per_repository:
+				new_worker = worker_type(repository_directory)
+				self._all[key].append(new_worker)
+				idle.put(new_worker)
+		current = idle.get()
+		try:
+			yield current
+		except Exception:
+			# The state of the pipes is unknown after a failure
+			current.close()
+			raise
+		finally:
+			idle.put(current)
+
+	def cat_file(self, repository_directory:str, object_name:str) -> GitObject:
+		with self.worker(CatFileWorker, repository_directory) as worker:
+			return worker.get(object_name)
+
+	def diff_stats(self, repository_directory:str, commit_hash:str, parent:str=None) -> DiffStat:
+		with self.worker(DiffTreeWorker, repository_directory) as worker:
+			return worker.get(commit_hash, parent)
+
+	# Stop the workers of a single repository, or of all repositories
+	def close(self, repository_directory:str=None):
+		with self._lock:
+			for key in list(self._all.keys()):
+				if repository_directory is None or key[1] == os.path.abspath(repository_directory):
+					for worker in self._all.pop(key):
+						worker.close()
+					self._idle.pop(key)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+_shared_pool = None
+
+# The pool used by the parsers when no pool is given explicitly
+def shared_pool() -> GitWorkerPool:
+	global _shared_pool
+	if _shared_pool is None:
+		_shared_pool = GitWorkerPool()
+	return _shared_pool
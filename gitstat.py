@@ -1,16 +1,15 @@
-import subprocess
-import requests
-import time
-import os
-import pytz
-from datetime import datetime
-from typing import List, Dict
+import threading
+import concurrent.futures
+from typing import List, Dict, Union
 import logging
 
 
-from common import ensure_path
 from gitparse_cache import GitStatCache
+from gitstat_ingest import IngestScheduler
+from gitstat_fetch import GitFetchEngine, is_repository
+from gitstat_http import MetadataClient, RateLimiter, pooled_network
 import gitparse
+import gitstat_metrics
 from gitstat_models import *
 
 
@@ -26,16 +25,30 @@ class GitStats:
 		if not cache:
 			self.cache = GitStatCache(config)
 
-		self.cwd = os.getcwd()
+		self._http = None
+		self._http_lock = threading.Lock()
+
+	# Created on first use, so that `requests` is only imported when GitHub is queried. The metadata threads share one client
+	# (and its rate limit and connections), so it is created under a lock. A request per thread is kept back from the rate limit.
+	@property
+	def http(self) -> MetadataClient:
+		if self._http is None:
+			with self._http_lock:
+				if self._http is None:
+					self._http = MetadataClient(pooled_network(self.config.network, self.config.metadata_workers), self.cache,
+												RateLimiter(reserve=self.config.metadata_workers))
+		return self._http
 
 	# Fetch repository metadata from github using the contents of repo_mappings_container ([{"tag": String, "org": String }])
+	# The organisations are fetched concurrently (see `GitStatConfig.metadata_workers`), sharing one rate limit.
 	def fetch_repositories_meta(self, repo_mappings: List[RepoMapping]) -> Dict[str, List[RepoMeta]]:
 		
 		metadata = dict()
 
-		for repo_mapping in repo_mappings:
-			metadata[repo_mapping.tag] = self._fetch_repository_meta(repo_mapping)
-			time.sleep(1)
+		with gitstat_metrics.timer("metadata"), concurrent.futures.ThreadPoolExecutor(max_workers=self.config.metadata_workers) as executor:
+			futures = [(repo_mapping, executor.submit(self._fetch_repository_meta, repo_mapping)) for repo_mapping in repo_mappings]
+			for (repo_mapping, future) in futures:
+				metadata[repo_mapping.tag] = future.result()
 		
 		return metadata
 
@@ -45,7 +58,7 @@ class GitStats:
 		if not repos_url:
 			return []
 		log.info(f"Fetchg repositories for {repo_mapping.tag} : {repos_url}")
-		response = self.config.network.get(repos_url)
+		response = self.http.get(repos_url)
 		if(response.status_code != 200):
 			log.error(f"ERROR: Invalid response for {repos_url}: {response.status_code}")
 			return []
@@ -60,11 +73,10 @@ class GitStats:
 				continue
 			if not self.config.include_forks and repo["fork"]:
 				continue
-			repo_meta = RepoMeta(repo["id"], repo["default_branch"], repo["clone_url"], repo["name"], repo["stargazers_count"], repo["watchers_count"], repo["forks_count"], repo["size"], repo_mapping.tag)
+			repo_meta = RepoMeta(repo["id"], repo["default_branch"], repo["clone_url"], repo["name"], repo["stargazers_count"], repo["watchers_count"], repo["forks_count"], repo["size"], repo_mapping.tag, pushed_at=repo.get("pushed_at"))
 			repo_metas.append(repo_meta)
 
 		if repo_count == self.config.repos_per_page:
-			time.sleep(1)
 			repo_metas = repo_metas + self._fetch_repository_meta(repo_mapping, page + 1)
 		
 		return repo_metas
@@ -79,40 +91,32 @@ class GitStats:
 			return None
 		return f"{self.config.base_url}/{path}?sort=updated&direction=desc&type=public&per_page={repo_count}&page={page}"
 
+	# Clone or update all repositories in parallel (see `GitStatConfig.fetch_workers` and `GitStatConfig.storage_mode`).
+	# Repositories whose `pushed_at` is the same as at the last successful fetch are not contacted at all.
 	def download_source_code(self, repos_metas:Dict[str, List[RepoMeta]]) -> Dict[str, List[RepoMeta]]:
-
-		for tag in repos_metas.keys():
-			os.chdir(self.cwd)
-			repo_metas = repos_metas[tag]
-			base_dir = self.config.tag_directory(tag)
-			ensure_path(base_dir)
-			for (i, repo_meta) in enumerate(repo_metas):
-				repo_dir = self.config.repo_directory(repo_meta)
-
-				if repo_meta.is_cloned or (os.path.isdir(repo_dir) and os.path.isdir(os.path.join(repo_dir, ".git"))):
-					log.info(f"Updating {repo_meta.repo_name} for {repo_meta.tag} ({repo_meta.url})")
-					subprocess.Popen(["git", "checkout", "."], cwd=repo_dir)
-					process = subprocess.Popen(["git", "pull"], stdout=subprocess.PIPE, cwd=repo_dir)
-					result, _ = process.communicate()
-					if not process.returncode == 0:
-						log.error("Failed to update:", repo_dir, "Message:", result.decode("utf8", 'ignore'))
-						repos_metas[tag][i].failed = repos_metas[tag][i].failed + 1
-					else:
-						repos_metas[tag][i].is_cloned = True
-						repos_metas[tag][i].failed = 0 
-				else:
-					ensure_path(repo_dir)
-					log.info(f"Cloning {repo_meta.repo_name} for {repo_meta.tag} ({repo_meta.url})")
-					process = subprocess.Popen(["git", "clone", repo_meta.url, repo_meta.repo_name], stdout=subprocess.PIPE, cwd=base_dir)
-					result, _ = process.communicate()
-					if not process.returncode == 0:
-						repos_metas[tag][i].failed = repos_metas[tag][i].failed + 1
-					else:
-						repos_metas[tag][i].cloned = True
-						repos_metas[tag][i].failed = 0
-			os.chdir(self.cwd)
+		outdated = dict()
+		for (tag, repo_metas) in repos_metas.items():
+			outdated[tag] = [repo_meta for repo_meta in repo_metas if not self._is_unchanged(repo_meta)]
+			skipped = len(repo_metas) - len(outdated[tag])
+			if skipped != 0:
+				log.info(f"{skipped} repositories for {tag} have not been pushed to since the last update")
+
+		with gitstat_metrics.timer("fetch"):
+			for result in GitFetchEngine.from_config(self.config).fetch(outdated):
+				if result.succeeded:
+					self.cache.update_fetch_state(result.repo_meta)
 		return repos_metas
 
+	def _is_unchanged(self, repo_meta:RepoMeta) -> bool:
+		if not repo_meta.pushed_at or not is_repository(self.config.repo_directory(repo_meta)):
+			return False
+		cached = self.cache.load_meta(repo_meta)
+		if cached is repo_meta or cached.pushed_at != repo_meta.pushed_at:
+			return False
+		repo_meta.is_cloned = True
+		repo_meta.remote_head = cached.remote_head
+		return True
+
 	def load_metas_from_cache(self, repo_mappings:List[RepoMapping]) -> Dict[str, List[RepoMeta]]:
 		repos_metas = dict()
 
@@ -120,59 +124,58 @@ class GitStats:
 			repos_metas[repo_mapping.tag] = list(self.cache.load_metas(repo_mapping))
 		return repos_metas
 
+	# Parse the repositories in parallel (see `GitStatConfig.ingest_workers`) and store their commits in the cache
 	def update_cache(self, repos_metas:Dict[str, List[RepoMeta]]) -> Dict[str, List[RepoMeta]]:
-
-		for tag in repos_metas.keys():
-			for (i, repo_meta) in enumerate(repos_metas[tag]):
-				repo_meta = self.cache.load_meta(repo_meta)
-				repos_metas[tag][i].last_commit_hash = self.cache.update_commits(repo_meta)
-		
-		return repos_metas
+		with gitstat_metrics.timer("ingest"):
+			return IngestScheduler(self.cache, self.config.ingest_workers).ingest_all(repos_metas)
 
 	def calculate_timestamp(self, commit_timestamp:int, period_interval:int) -> int:
 		periods = int(commit_timestamp / period_interval) + 1
 		return periods * period_interval
 
-	# Generate stats for a single repository
-	def generate_repository_stats(self, period_interval:int, repo_meta:RepoMeta=None, commits:List[gitparse.CommitData]=None) -> GitStatRepository:
-		stats = dict()
-		current = None
+	# Generate stats for a single repository. `commits` can also be a `gitparse.CommitBatch`, whose columns are summed directly.
+	def generate_repository_stats(self, period_interval:int, repo_meta:RepoMeta=None, commits:Union[List[gitparse.CommitData], gitparse.CommitBatch]=None) -> GitStatRepository:
 		if not commits:
 			assert(repo_meta)
-			commits = self.cache.get_commits(repo_meta)
-		for commit in commits:
-			if commit.date < self.config.max_history_time:
+			entries = self.cache.aggregate_commits(period_interval, repo_meta.tag, [repo_meta.repo_name], self.config.max_history_time)
+			return GitStatRepository(entries, repo_meta, period_interval)
+
+		if isinstance(commits, gitparse.CommitBatch):
+			columns = zip(commits.dates, commits.insertions, commits.deletions)
+		else:
+			columns = ((commit.date, commit.insertions, commit.deletions) for commit in commits)
+
+		stats = dict()
+		for (date, insertions, deletions) in columns:
+			if date < self.config.max_history_time:
 				continue
-			timestamp = self.calculate_timestamp(commit.date, period_interval)
-			if timestamp in stats:
-				current = stats[timestamp]
-				current.add(commit)
+			timestamp = self.calculate_timestamp(date, period_interval)
+			current = stats.get(timestamp)
+			if current:
+				current.add_stats(insertions, deletions)
 			else:
-				current = GitStatEntry(timestamp=timestamp, 
+				stats[timestamp] = GitStatEntry(timestamp=timestamp, 
 								  period_interval=period_interval, 
-								  change_count=commit.insertions+commit.deletions, 
+								  change_count=insertions+deletions, 
 								  commit_count=1, 
-								  insertions=commit.insertions, 
-								  deletions=commit.deletions)
-		
-			stats[timestamp] = current
+								  insertions=insertions, 
+								  deletions=deletions)
 		
 		return GitStatRepository(stats.values(), repo_meta, period_interval)
 
-	# Generate stats for a set of repositories
-	def generate_stats(self, period_interval:int, repo_metas:List[RepoMeta]) -> [GitStatEntry]:
-		stats = dict()
-		current = None
+	# Generate stats for a set of repositories. The periods are summed by the cache, using one query per tag.
+	# `distinct`: count commits shared by several repositories of a tag once (see `GitStatCache.aggregate_commits`).
+	def generate_stats(self, period_interval:int, repo_metas:List[RepoMeta], distinct:bool=False) -> [GitStatEntry]:
+		repo_names = dict()
 		for repo_meta in repo_metas:
+			repo_names.setdefault(repo_meta.tag, []).append(repo_meta.repo_name)
 
-			repository_stats = self.generate_repository_stats(period_interval, repo_meta)
-			for entry in repository_stats.entries:
+		stats = dict()
+		for (tag, names) in repo_names.items():
+			for entry in self.cache.aggregate_commits(period_interval, tag, names, self.config.max_history_time, distinct):
 				if entry.timestamp in stats:
-					current = stats[entry.timestamp]
-					current.add(entry)
+					stats[entry.timestamp].merge(entry)
 				else:
-					current = entry
-
-				stats[entry.timestamp] = current
+					stats[entry.timestamp] = entry
 
-		return stats.values()
\ No newline at end of file
+		return stats.values()
@@ -0,0 +1,149 @@
+# Command line entry point. pandas is only imported by `export`, and requests only when GitHub is queried (`sync`).
+#
+# python gitstat_cli.py sync --org BonkLabs:BONK                  Fetch metadata, clone/update and ingest the repositories
+# python gitstat_cli.py ingest --org BonkLabs:BONK                Ingest the cached repositories (no network access)
+# python gitstat_cli.py aggregate --org BonkLabs:BONK --interval 86400   Print the stats per period as JSON lines
+# python gitstat_cli.py commits --org BonkLabs:BONK --start 1700000000 --end 1700086400   Print the cached commits as JSON lines
+# python gitstat_cli.py export --org BonkLabs:BONK --interval 86400 --output ./frames   Write the stats frames as CSV
+# python gitstat_cli.py daemon --org BonkLabs:BONK                Keep the repositories and the cache up to date
+#
+# `--org` takes `<organisation>[:<tag>]` and can be repeated.
+
+import json
+import argparse
+import logging
+
+from common import GIT_PARSE_LOGGER_ID
+from gitstat_models import *
+
+log = logging.getLogger(GIT_PARSE_LOGGER_ID)
+
+def repo_mapping(value:str) -> RepoMapping:
+	org, _, tag = value.partition(":")
+	return RepoMapping(org=org, tag=tag or None)
+
+def config_from_arguments(arguments) -> GitStatConfig:
+	return GitStatConfig(repository_path=arguments.repository_path,
+						 cache_path=arguments.cache_path,
+						 max_history_time=arguments.max_history_time,
+						 include_forks=arguments.include_forks,
+						 storage_mode=arguments.storage_mode,
+						 bare=arguments.bare,
+						 ingest_workers=arguments.ingest_workers,
+						 fetch_workers=arguments.fetch_workers,
+						 deduplicate_commits=arguments.deduplicate)
+
+def sync(arguments):
+	import gitstat
+	stats = gitstat.GitStats(config_from_arguments(arguments))
+	if arguments.from_cache:
+		repos_metas = stats.load_metas_from_cache(arguments.org)
+	else:
+		repos_metas = stats.fetch_repositories_meta(arguments.org)
+	if not arguments.no_fetch:
+		repos_metas = stats.download_source_code(repos_metas)
+	stats.update_cache(repos_metas)
+
+def ingest(arguments):
+	import gitstat
+	stats = gitstat.GitStats(config_from_arguments(arguments))
+	stats.update_cache(stats.load_metas_from_cache(arguments.org))
+
+def aggregate(arguments):
+	from gitparse_cache import GitStatCache
+	config = config_from_arguments(arguments)
+	cache = GitStatCache(config)
+	for mapping in arguments.org:
+		entries = cache.query_aggregates(arguments.interval, mapping.tag, arguments.start or config.max_history_time, arguments.end,
+										 arguments.repo, arguments.author, arguments.distinct)
+		for entry in entries:
+			print(json.dumps(dict(entry.as_dict, tag=mapping.tag)))
+
+def commits(arguments):
+	from gitparse_cache import GitStatCache
+	config = config_from_arguments(arguments)
+	cache = GitStatCache(config)
+	for mapping in arguments.org:
+		for (repo_name, commit) in cache.query_commits(mapping.tag, arguments.start or config.max_history_time, arguments.end, arguments.repo, arguments.author):
+			print(json.dumps({"tag": mapping.tag, "repo": repo_name, "commit_hash": commit.commit_hash, "timestamp": commit.date,
+							  "author": commit.author.to_dict(), "insertions": commit.insertions, "deletions": commit.deletions}))
+
+def export(arguments):
+	import os
+	from common import ensure_path
+	from gitstat_pd import GitStatPd
+	stats_pd = GitStatPd(config_from_arguments(arguments))
+	ensure_path(arguments.output)
+	for data in stats_pd.synchronize(arguments.org, arguments.interval, load_meta_from_github=False, update_repos=False):
+		path = os.path.join(arguments.output, f"{data.file_name}.csv")
+		data.df.to_csv(path, index=False)
+		log.info(f"Exported {path}")
+
+def daemon(arguments):
+	from gitstat_daemon import GitStatDaemon
+	GitStatDaemon(config_from_arguments(arguments), arguments.org, arguments.concurrency, metadata_interval=arguments.metadata_interval).run()
+
+def parser() -> argparse.ArgumentParser:
+	main_parser = argparse.ArgumentParser(description="Derive commit statistics from GitHub organisations")
+	main_parser.add_argument("--repository-path", default="./repos", help="Where repositories are cloned")
+	main_parser.add_argument("--cache-path", default="./cache", help="Where the cache database and frames are stored")
+	main_parser.add_argument("--max-history-time", type=int, default=0, help="Ignore commits before this unix timestamp")
+	main_parser.add_argument("--include-forks", action="store_true")
+	main_parser.add_argument("--storage-mode", choices=STORAGE_MODES, default=STORAGE_FULL)
+	main_parser.add_argument("--bare", action="store_true", help="Clone without a working tree")
+	main_parser.add_argument("--ingest-workers", type=int, default=None)
+	main_parser.add_argument("--fetch-workers", type=int, default=8)
+	main_parser.add_argument("--deduplicate", action="store_true", help="Reuse the stats of commits shared with other repositories (forks, mirrors)")
+	main_parser.add_argument("--metrics", help="Write metrics (see gitstat_metrics) to this JSON file")
+	main_parser.add_argument("-v", "--verbose", action="store_true")
+
+	subparsers = main_parser.add_subparsers(dest="command", required=True)
+
+	def subparser(name:str, function, help:str) -> argparse.ArgumentParser:
+		command_parser = subparsers.add_parser(name, help=help)
+		command_parser.add_argument("--org", type=repo_mapping, action="append", required=True, help="<organisation>[:<tag>], can be repeated")
+		command_parser.set_defaults(function=function)
+		return command_parser
+
+	sync_parser = subparser("sync", sync, "Fetch metadata, clone or update and ingest the repositories")
+	sync_parser.add_argument("--from-cache", action="store_true", help="Use the cached metadata instead of querying GitHub")
+	sync_parser.add_argument("--no-fetch", action="store_true", help="Do not clone or update the repositories")
+
+	subparser("ingest", ingest, "Ingest the new commits of the cached repositories")
+
+	def range_arguments(command_parser:argparse.ArgumentParser):
+		command_parser.add_argument("--start", type=int, help="Only include commits at or after this unix timestamp (default: --max-history-time)")
+		command_parser.add_argument("--end", type=int, help="Only include commits before this unix timestamp")
+		command_parser.add_argument("--repo", action="append", help="Only include this repository, can be repeated")
+		command_parser.add_argument("--author", action="append", help="Only include commits by this author e-mail, can be repeated")
+
+	aggregate_parser = subparser("aggregate", aggregate, "Print the stats per period as JSON lines")
+	aggregate_parser.add_argument("--interval", type=int, default=24 * 3600, help="Period length in seconds")
+	aggregate_parser.add_argument("--distinct", action="store_true", help="Count commits shared by several repositories once")
+	range_arguments(aggregate_parser)
+
+	range_arguments(subparser("commits", commits, "Print the cached commits as JSON lines, oldest first"))
+
+	export_parser = subparser("export", export, "Write the stats frames as CSV files")
+	export_parser.add_argument("--interval", type=int, action="append", required=True, help="Period length in seconds, can be repeated")
+	export_parser.add_argument("--output", default=".", help="Output directory")
+
+	daemon_parser = subparser("daemon", daemon, "Refresh the repositories continuously until interrupted")
+	daemon_parser.add_argument("--concurrency", type=int, default=4, help="Number of repositories refreshed at a time")
+	daemon_parser.add_argument("--metadata-interval", type=int, default=15 * 60, help="Seconds between metadata updates from GitHub (0: only use the cached metadata)")
+
+	return main_parser
+
+def main(argv=None):
+	arguments = parser().parse_args(argv)
+	logging.basicConfig(level=logging.INFO if arguments.verbose else logging.WARNING, format="%(asctime)s %(message)s")
+	log.setLevel(logging.INFO if arguments.verbose else logging.WARNING)
+	if arguments.metrics:
+		import gitstat_metrics
+		gitstat_metrics.enable(gitstat_metrics.JsonFileSink(arguments.metrics))
+	arguments.function(arguments)
+	if arguments.metrics:
+		gitstat_metrics.flush()
+
+if __name__ == '__main__':
+	main()
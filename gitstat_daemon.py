@@ -0,0 +1,266 @@
+import time
+import heapq
+import queue
+import threading
+from datetime import datetime
+from typing import List, Callable
+import logging
+
+from common import ensure_path, GIT_PARSE_LOGGER_ID
+import gitparse
+import gitstat_metrics
+from gitstat import GitStats
+from gitstat_fetch import GitFetchEngine, GitFetchError
+from gitstat_ingest import IngestScheduler
+from gitstat_models import *
+
+log = logging.getLogger(GIT_PARSE_LOGGER_ID)
+
+# Bounds of the time between two refreshes of a repository (in seconds)
+MIN_REFRESH_INTERVAL = 5 * 60
+MAX_REFRESH_INTERVAL = 24 * 3600
+# A repository is refreshed after this fraction of the time since its last activity (last commit or push) has passed
+ACTIVITY_FACTOR = 0.1
+# A repository that failed `n` times in a row waits 2^n times longer, but never longer than this
+MAX_BACKOFF_INTERVAL = 7 * 24 * 3600
+# How often the repository metadata is reloaded from GitHub to find new repositories and pushes
+METADATA_INTERVAL = 15 * 60
+
+# Seconds since the epoch of a GitHub timestamp (`pushed_at`), or 0
+def github_timestamp(value:str) -> int:
+	if not value:
+		return 0
+	try:
+		return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
+	except ValueError:
+		return 0
+
+# A min-heap of (due time, priority, sequence, key). Each key is scheduled at most once; `schedule` replaces an earlier entry.
+class RefreshScheduler:
+
+	def __init__(self, clock=time.time):
+		self.clock = clock
+		self._heap = []
+		self._entries = dict()
+		self._sequence = 0
+		self._condition = threading.Condition()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def schedule(self, key, due:float, priority:float=0):
+		with self._condition:
+			self._sequence = self._sequence + 1
+			entry = [due, priority, self._sequence, key]
+			self._entries[key] = entry
+			heapq.heappush(self._heap, entry)
+			self._condition.notify_all()
+
+	def cancel(self, key):
+		with self._condition:
+			self._entries.pop(key, None)
+
+	def due(self, key) -> float:
+		entry = self._entries.get(key)
+		return entry[0] if entry else None
+
+	def _pop_due(self):
+		while self._heap and self._entries.get(self._heap[0][3]) is not self._heap[0]:
+			# Replaced or cancelled
+			heapq.heappop(self._heap)
+		if self._heap and self._heap[0][0] <= self.clock():
+			entry = heapq.heappop(self._heap)
+			del self._entries[entry[3]]
+			return entry[3]
+		return None
+
+	# Remove and return the key of the next entry that is due. Waits until it is due, but at most `timeout` seconds
+	# or until `schedule` or `wake` is called, and returns None if no entry is due by then.
+	def pop(self, timeout:float=None):
+		with self._condition:
+			key = self._pop_due()
+			if key is not None:
+				return key
+			wait = timeout
+			if self._heap:
+				wait = self._heap[0][0] - self.clock() if wait is None else min(wait, self._heap[0][0] - self.clock())
+			self._condition.wait(wait)
+			return self._pop_due()
+
+	def wake(self):
+		with self._condition:
+			self._condition.notify_all()
+
+# Keeps repositories up to date without periodic full sweeps. The cache connection, the repository metadata and the
+# git processes stay open between refreshes:
+#
+# - Every repository has its own refresh interval, which is shorter the more recently it was active and grows
+#   exponentially with `RepoMeta.failed` (see `refresh_interval`).
+# - Due repositories are put in a work queue of `queue_size` and refreshed (fetched and ingested) by `concurrency` threads.
+#   The scheduler blocks while the queue is full.
+# - The metadata is reloaded from GitHub every `metadata_interval` seconds (0 to only use the cached metadata).
+#   A repository whose `pushed_at` changed is refreshed right away, or right after its refresh if one is running.
+# - `RepoMeta.failed` is stored in the cache, so the backoff survives a restart.
+#
+# `on_refresh(repo_meta, commit_count)` is called after a repository received new commits.
+class GitStatDaemon:
+
+	def __init__(self, config:GitStatConfig, repo_mappings:List[RepoMapping], concurrency:int=4, queue_size:int=None,
+				 metadata_interval:int=METADATA_INTERVAL, on_refresh:Callable[[RepoMeta, int], None]=None, clock=time.time):
+		self.config = config
+		self.repo_mappings = repo_mappings
+		self.concurrency = concurrency
+		self.metadata_interval = metadata_interval
+		self.on_refresh = on_refresh
+		self.clock = clock
+		self.stats = GitStats(config)
+		self.cache = self.stats.cache
+		self.fetch_engine = GitFetchEngine.from_config(config)
+		self.ingester = IngestScheduler(self.cache)
+		self.scheduler = RefreshScheduler(clock)
+		self.work_queue = queue.Queue(maxsize=queue_size or concurrency * 2)
+		self.repo_metas = dict()
+		# Keys of the repositories in the work queue or being refreshed, and the ones of them to refresh again right away
+		self._in_flight = set()
+		self._refresh_again = set()
+		self._lock = threading.Lock()
+		self._stopped = threading.Event()
+		self._next_metadata_update = 0
+		self._threads = []
+
+	@staticmethod
+	def key(repo_meta:RepoMeta):
+		return (repo_meta.tag, repo_meta.id)
+
+	# Unix timestamp of the last commit or push of `repo_meta`
+	def last_activity(self, repo_meta:RepoMeta) -> int:
+		with self.cache.lock:
+			last_commit = self.cache.last_commit_timestamp(repo_meta) or 0
+		return max(last_commit, github_timestamp(repo_meta.pushed_at))
+
+	def refresh_interval(self, repo_meta:RepoMeta, now:float) -> float:
+		idle = max(0, now - self.last_activity(repo_meta))
+		interval = min(max(idle * ACTIVITY_FACTOR, MIN_REFRESH_INTERVAL), MAX_REFRESH_INTERVAL)
+		if repo_meta.failed:
+			interval = min(interval * 2 ** min(repo_meta.failed, 32), MAX_BACKOFF_INTERVAL)
+		return interval
+
+	def schedule(self, repo_meta:RepoMeta, due:float=None):
+		now = self.clock()
+		if due is None:
+			due = now + self.refresh_interval(repo_meta, now)
+		# The most recently active repositories go first if several are due
+		self.scheduler.schedule(self.key(repo_meta), due, -self.last_activity(repo_meta))
+
+	# Load the metadata and schedule new repositories right away and the ones that were pushed to since the last update
+	def update_metadata(self, from_github:bool):
+		if from_github:
+			repos_metas = self.stats.fetch_repositories_meta(self.repo_mappings)
+		else:
+			with self.cache.lock:
+				repos_metas = self.stats.load_metas_from_cache(self.repo_mappings)
+		now = self.clock()
+		for repo_metas in repos_metas.values():
+			for repo_meta in repo_metas:
+				key = self.key(repo_meta)
+				known = self.repo_metas.get(key)
+				if known is None:
+					with self.cache.lock:
+						cached = self.cache.load_meta(repo_meta)
+					repo_meta.last_commit_hash = cached.last_commit_hash
+					repo_meta.remote_head = cached.remote_head
+					repo_meta.failed = cached.failed
+					self.repo_metas[key] = repo_meta
+					self.schedule(repo_meta, now)
+				elif repo_meta.pushed_at and repo_meta.pushed_at != known.pushed_at:
+					known.pushed_at = repo_meta.pushed_at
+					with self._lock:
+						if key in self._in_flight:
+							# Rescheduled by `_work` once the running refresh has finished
+							self._refresh_again.add(key)
+							continue
+					self.schedule(known, now)
+
+	# Fetch and ingest a repository. Returns the number of new commits.
+	def refresh(self, repo_meta:RepoMeta) -> int:
+		with gitstat_metrics.timer("daemon.refresh", gitstat_metrics.repo_label(repo_meta)):
+			result = self.fetch_engine.fetch_repository(repo_meta)
+			if not result.succeeded:
+				raise GitFetchError(result.error)
+			repo_meta.is_cloned = True
+			with self.cache.lock:
+				self.cache.update_fetch_state(repo_meta)
+			return self.ingester.ingest_repository(repo_meta)
+
+	def _work(self):
+		while True:
+			repo_meta = self.work_queue.get()
+			if repo_meta is None:
+				return
+			failed = repo_meta.failed
+			try:
+				commit_count = self.refresh(repo_meta)
+				repo_meta.failed = 0
+				if commit_count != 0:
+					log.info(f"{repo_meta.tag} {repo_meta.repo_name}: {commit_count} new commits")
+					if self.on_refresh:
+						self.on_refresh(repo_meta, commit_count)
+			except Exception as e:
+				repo_meta.failed = repo_meta.failed + 1
+				log.error(f"Failed to refresh {repo_meta.tag} {repo_meta.repo_name} ({repo_meta.failed} times): {e}")
+			finally:
+				if repo_meta.failed != failed:
+					with self.cache.lock:
+						self.cache.update_failed(repo_meta)
+				key = self.key(repo_meta)
+				with self._lock:
+					self._in_flight.discard(key)
+					refresh_again = key in self._refresh_again
+					self._refresh_again.discard(key)
+				if not self._stopped.is_set():
+					self.schedule(repo_meta, self.clock() if refresh_again else None)
+
+	def start(self):
+		for tag in [repo_mapping.tag for repo_mapping in self.repo_mappings]:
+			ensure_path(self.config.tag_directory(tag))
+		self._threads = [threading.Thread(target=self._work, name=f"gitstat-refresh-{i}", daemon=True) for i in range(self.concurrency)]
+		for thread in self._threads:
+			thread.start()
+
+	# Dispatch due repositories until `stop` is called or the process is interrupted
+	def run(self):
+		self.start()
+		try:
+			self.update_metadata(from_github=False)
+			while not self._stopped.is_set():
+				now = self.clock()
+				if self.metadata_interval and now >= self._next_metadata_update:
+					try:
+						self.update_metadata(from_github=True)
+					except Exception as e:
+						log.error(f"Failed to update the repository metadata: {e}")
+					self._next_metadata_update = now + self.metadata_interval
+				timeout = max(0, self._next_metadata_update - now) if self.metadata_interval else None
+				key = self.scheduler.pop(timeout)
+				if key is not None and not self._stopped.is_set():
+					with self._lock:
+						self._in_flight.add(key)
+					# Blocks while `concurrency` refreshes are running and the queue is full
+					self.work_queue.put(self.repo_metas[key])
+		except KeyboardInterrupt:
+			log.info("Interrupted")
+		finally:
+			self._stopped.set()
+			self._shutdown()
+
+	def stop(self):
+		self._stopped.set()
+		self.scheduler.wake()
+
+	def _shutdown(self):
+		for _ in self._threads:
+			self.work_queue.put(None)
+		for thread in self._threads:
+			thread.join()
+		gitparse.gitparse_worker.shared_pool().close()
+		gitstat_metrics.flush()
@@ -0,0 +1,172 @@
+import os
+import time
+import shutil
+import subprocess
+import concurrent.futures
+from typing import List, Dict
+import logging
+
+from common import ensure_path, GIT_PARSE_LOGGER_ID
+import gitstat_metrics
+from gitstat_models import *
+import gitparse
+
+log = logging.getLogger(GIT_PARSE_LOGGER_ID)
+
+class GitFetchError(Exception):
+	pass
+
+# Number of commits of the first fetch of a shallow clone (see `GitFetchEngine.deepen`)
+SHALLOW_CLONE_DEPTH = 64
+
+class FetchResult:
+
+	def __init__(self, repo_meta:RepoMeta, cloned:bool, duration:float, error:str=None, skipped:bool=False):
+		self.repo_meta = repo_meta
+		self.cloned = cloned
+		self.duration = duration
+		self.error = error
+		# True if the remote HEAD was already checked out, so nothing was fetched
+		self.skipped = skipped
+
+	@property
+	def succeeded(self) -> bool:
+		return self.error is None
+
+	def __str__(self):
+		action = "clone" if self.cloned else ("up to date" if self.skipped else "fetch")
+		status = "ok" if self.succeeded else f"failed: {self.error}"
+		return f"{self.repo_meta.tag} {self.repo_meta.repo_name} {action} {self.duration:.2f}s {status}"
+
+# True if `path` contains a git repository with a working tree or a bare repository
+def is_repository(path:str) -> bool:
+	return os.path.isdir(os.path.join(path, ".git")) or os.path.isfile(os.path.join(path, "HEAD"))
+
+# Clones and updates repositories using a pool of worker threads (the work itself is done by git processes).
+#
+# `partial_filter`: passed to `--filter` (i.e. "blob:none") to create partial clones.
+# `shallow_since`: unix timestamp. Shallow clones are deepened until the commits since then can be diffed against
+#                  their parents (see `deepen`).
+# `bare`: clone without a working tree.
+# Repositories are updated using `git fetch` + `git update-ref`, which never touches the working tree.
+class GitFetchEngine:
+
+	def __init__(self, config:GitStatConfig, max_workers:int=8, partial_filter:str=None, shallow_since:int=None, bare:bool=False):
+		self.config = config
+		self.max_workers = max_workers
+		self.partial_filter = partial_filter
+		self.shallow_since = shallow_since
+		self.bare = bare
+
+	# Use the storage mode of `config` (see `GitStatConfig.storage_mode`)
+	@staticmethod
+	def from_config(config:GitStatConfig) -> 'GitFetchEngine':
+		return GitFetchEngine(config, config.fetch_workers, config.partial_clone_filter, config.shallow_since, config.bare)
+
+	def _run(self, command:List[str], cwd:str) -> str:
+		env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+		process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, env=env)
+		gitstat_metrics.count("git.subprocesses")
+		if process.returncode != 0:
+			raise GitFetchError(f"'{' '.join(command)}' failed ({process.returncode}): {process.stderr.decode('utf8', 'ignore').strip()}")
+		return process.stdout.decode('utf8', 'ignore')
+
+	# The hash the remote branch points to, without downloading any objects
+	def remote_head(self, repo_meta:RepoMeta, repo_dir:str) -> str:
+		output = self._run(["git", "ls-remote", "origin", repo_meta.default_branch or "HEAD"], repo_dir)
+		for line in output.splitlines():
+			remote_hash, ref = line.split("\t", 1)
+			if ref in ["HEAD", f"refs/heads/{repo_meta.default_branch}"]:
+				return remote_hash
+		return None
+
+	# The filter and the shallow boundary are stored in the clone, so later fetches only need the new commits.
+	# Shallow clones are limited by depth rather than `--shallow-since`: when the date cuts through a merge, git leaves the
+	# clone in a state that can be neither deepened nor unshallowed ("error in object: unshallow").
+	def clone_command(self, repo_meta:RepoMeta) -> List[str]:
+		command = ["git", "clone", "--quiet"]
+		if self.bare:
+			command.append("--bare")
+		if self.partial_filter:
+			command.append(f"--filter={self.partial_filter}")
+		if self.shallow_since:
+			command.append(f"--depth={SHALLOW_CLONE_DEPTH}")
+		return command + [repo_meta.url, repo_meta.repo_name]
+
+	# The commits of a shallow clone whose parents have not been fetched, and that are not older than `shallow_since`.
+	# The shallow file can also list commits that have not been fetched themselves; these are included.
+	def shallow_boundary(self, repo_dir:str) -> List[str]:
+		shallow_path = self._run(["git", "rev-parse", "--git-path", "shallow"], repo_dir).strip()
+		shallow_path = os.path.join(repo_dir, shallow_path)
+		if not os.path.isfile(shallow_path):
+			return []
+		with open(shallow_path) as shallow_file:
+			shallow = shallow_file.read().split()
+		if len(shallow) == 0:
+			return []
+		output = self._run(["git", "log", "--no-walk", "--ignore-missing", "--format=%H %at"] + shallow, repo_dir)
+		dates = dict(line.split(" ") for line in output.splitlines() if line)
+		return [commit_hash for commit_hash in shallow if commit_hash not in dates or int(dates[commit_hash]) >= self.shallow_since]
+
+	# Fetch the parents of the commits of a shallow clone since `shallow_since`. Without them, these commits would be diffed
+	# against the empty tree. The depth is doubled until the boundary is older than `shallow_since`.
+	def deepen(self, repo_meta:RepoMeta, repo_dir:str):
+		depth = SHALLOW_CLONE_DEPTH
+		while len(self.shallow_boundary(repo_dir)) != 0:
+			depth = depth * 2
+			log.info(f"Deepening {repo_meta.repo_name} for {repo_meta.tag} to {depth} commits")
+			self._run(["git", "fetch", "--quiet", f"--depth={depth}", "origin", repo_meta.default_branch or "HEAD"], repo_dir)
+
+	def fetch_command(self, repo_meta:RepoMeta) -> List[str]:
+		return ["git", "fetch", "--quiet", "origin", repo_meta.default_branch or "HEAD"]
+
+	def fetch_repository(self, repo_meta:RepoMeta) -> FetchResult:
+		with gitstat_metrics.timer("fetch.repository", gitstat_metrics.repo_label(repo_meta)):
+			return self._fetch_repository(repo_meta)
+
+	def _fetch_repository(self, repo_meta:RepoMeta) -> FetchResult:
+		repo_dir = self.config.repo_directory(repo_meta)
+		cloned = not is_repository(repo_dir)
+		start = time.monotonic()
+		try:
+			if cloned:
+				log.info(f"Cloning {repo_meta.repo_name} for {repo_meta.tag} ({repo_meta.url})")
+				try:
+					self._run(self.clone_command(repo_meta), self.config.tag_directory(repo_meta.tag))
+					if self.shallow_since:
+						self.deepen(repo_meta, repo_dir)
+				except GitFetchError:
+					# An incomplete clone would be taken for a repository and only be fetched from then on
+					shutil.rmtree(repo_dir, ignore_errors=True)
+					raise
+			else:
+				remote_head = self.remote_head(repo_meta, repo_dir)
+				if remote_head and remote_head == gitparse.head_hash(repo_dir):
+					repo_meta.remote_head = remote_head
+					return FetchResult(repo_meta, cloned, time.monotonic() - start, skipped=True)
+				log.info(f"Updating {repo_meta.repo_name} for {repo_meta.tag} ({repo_meta.url})")
+				self._run(self.fetch_command(repo_meta), repo_dir)
+				self._run(["git", "update-ref", "HEAD", "FETCH_HEAD"], repo_dir)
+			repo_meta.remote_head = gitparse.head_hash(repo_dir)
+		except GitFetchError as e:
+			return FetchResult(repo_meta, cloned, time.monotonic() - start, str(e))
+		return FetchResult(repo_meta, cloned, time.monotonic() - start)
+
+	# Clone or update all repositories. `RepoMeta.is_cloned` and `RepoMeta.failed` are updated with the results.
+	def fetch(self, repos_metas:Dict[str, List[RepoMeta]]) -> List[FetchResult]:
+		results = []
+		for tag in repos_metas.keys():
+			ensure_path(self.config.tag_directory(tag))
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			futures = [executor.submit(self.fetch_repository, repo_meta) for repo_metas in repos_metas.values() for repo_meta in repo_metas]
+			for future in concurrent.futures.as_completed(futures):
+				result = future.result()
+				if result.succeeded:
+					result.repo_meta.is_cloned = True
+					result.repo_meta.failed = 0
+					log.info(f"{result}")
+				else:
+					result.repo_meta.failed = result.repo_meta.failed + 1
+					log.error(f"{result}")
+				results.append(result)
+		return results
@@ -0,0 +1,110 @@
+import json
+import time
+import threading
+from typing import Dict
+import logging
+
+from common import GIT_PARSE_LOGGER_ID
+import gitstat_metrics
+
+log = logging.getLogger(GIT_PARSE_LOGGER_ID)
+
+# Time between two requests while the rate limit is not close to being exhausted
+DEFAULT_REQUEST_INTERVAL = 0.1
+
+# Paces requests using the rate limit headers of the responses. Requests are sent `default_interval` apart until the
+# remaining requests (`X-RateLimit-Remaining`) drop to `reserve`, and then wait until the limit is reset (`X-RateLimit-Reset`).
+# `reserve` leaves room for the requests that are sent concurrently. `Retry-After` delays the next request as well.
+# Responses answered with 304 Not Modified do not count against the rate limit, and do not take up an interval either.
+class RateLimiter:
+
+	def __init__(self, default_interval:float=DEFAULT_REQUEST_INTERVAL, reserve:int=0, clock=time.time, sleep=time.sleep):
+		self.default_interval = default_interval
+		self.reserve = reserve
+		self.clock = clock
+		self.sleep = sleep
+		self._lock = threading.Lock()
+		self._next_request = 0
+
+	# Block until the next request may be sent
+	def wait(self):
+		with self._lock:
+			now = self.clock()
+			delay = self._next_request - now
+			self._next_request = max(now, self._next_request) + self.default_interval
+		if delay > 0:
+			self.sleep(delay)
+
+	def update(self, headers:Dict[str, str], status_code:int=200):
+		now = self.clock()
+		with self._lock:
+			if status_code == 304:
+				self._next_request = max(now, self._next_request - self.default_interval)
+			retry_after = headers.get("Retry-After")
+			remaining = headers.get("X-RateLimit-Remaining")
+			reset = headers.get("X-RateLimit-Reset")
+			if retry_after is not None:
+				self._next_request = max(self._next_request, now + float(retry_after))
+			elif remaining is not None and reset is not None and int(remaining) <= self.reserve and int(reset) > now:
+				seconds_to_reset = int(reset) - now
+				log.warning(f"Rate limit almost exhausted ({remaining} requests left). Waiting {seconds_to_reset:.0f}s.")
+				self._next_request = max(self._next_request, now + seconds_to_reset)
+
+# Returns a `requests.Session` with a connection pool of `pool_size` if `network` is the `requests` module, so that
+# connections are reused across requests. Any other network object (i.e. a stub) is returned as it is.
+def pooled_network(network, pool_size:int):
+	if not hasattr(network, "Session") or not hasattr(network, "adapters"):
+		return network
+	session = network.Session()
+	adapter = network.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+	session.mount("https://", adapter)
+	session.mount("http://", adapter)
+	return session
+
+# The result of `MetadataClient.get`. Responses answered with 304 are returned with the cached body and status code 200.
+class MetadataResponse:
+
+	def __init__(self, status_code:int, text:str, headers:Dict[str, str]=None, from_cache:bool=False):
+		self.status_code = status_code
+		self.text = text
+		self.headers = headers or dict()
+		self.from_cache = from_cache
+
+	def json(self):
+		return json.loads(self.text)
+
+# Sends GET requests using `network` (`GitStatConfig.network`, any object with a `requests`-like `get(url, headers=...)`).
+# ETag and Last-Modified of every response are stored in `cache`, and sent as If-None-Match/If-Modified-Since later,
+# so that unchanged resources are answered with 304 Not Modified.
+class MetadataClient:
+
+	def __init__(self, network, cache, rate_limiter:RateLimiter=None):
+		self.network = network
+		self.cache = cache
+		self.rate_limiter = rate_limiter or RateLimiter()
+
+	def get(self, url:str) -> MetadataResponse:
+		cached = self.cache.load_http_response(url)
+		headers = dict()
+		if cached:
+			etag, last_modified, _ = cached
+			if etag:
+				headers["If-None-Match"] = etag
+			if last_modified:
+				headers["If-Modified-Since"] = last_modified
+
+		self.rate_limiter.wait()
+		response = self.network.get(url, headers=headers)
+		gitstat_metrics.count("http.requests")
+		self.rate_limiter.update(response.headers, response.status_code)
+
+		if response.status_code == 304 and cached:
+			log.info(f"Not modified: {url}")
+			gitstat_metrics.count("http.cache_hits")
+			return MetadataResponse(200, cached[2], response.headers, from_cache=True)
+		if response.status_code == 200:
+			etag = response.headers.get("ETag")
+			last_modified = response.headers.get("Last-Modified")
+			if etag or last_modified:
+				self.cache.store_http_response(url, etag, last_modified, response.text)
+		return MetadataResponse(response.status_code, response.text, response.headers)
@@ -0,0 +1,187 @@
+import os
+import queue
+import multiprocessing
+import concurrent.futures
+from typing import List, Dict, Iterator, Tuple
+import logging
+
+from common import GIT_PARSE_LOGGER_ID
+import gitparse
+import gitstat_metrics
+from gitparse_cache import GitStatCache, CommitStatsReader
+from gitstat_fetch import is_repository
+from gitstat_models import *
+
+log = logging.getLogger(GIT_PARSE_LOGGER_ID)
+
+# Number of commits a worker sends to the writer at a time
+INGEST_BATCH_SIZE = 1000
+
+# Messages sent from the worker processes to the writer
+MESSAGE_COMMITS = "commits"
+MESSAGE_DONE = "done"
+# The metrics of a worker (see `gitstat_metrics.Metrics.snapshot`), sent before MESSAGE_DONE if metrics are enabled
+MESSAGE_METRICS = "metrics"
+
+_queue = None
+# Stats of the commits that are already in the cache (see `GitStatConfig.deduplicate_commits`), or None
+_known_stats = None
+
+def _init_worker(message_queue, db_path:str=None):
+	global _queue, _known_stats
+	_queue = message_queue
+	_known_stats = CommitStatsReader(db_path) if db_path else None
+
+# The commit to ingest `repo_meta` up to, or None if there is nothing to ingest: the clone failed (and was removed), the
+# repository is empty or nothing has been committed since the last ingestion.
+def ingest_head(config:GitStatConfig, repo_meta:RepoMeta) -> str:
+	repo_dir = config.repo_directory(repo_meta)
+	if not is_repository(repo_dir):
+		log.info(f"Skipping {repo_meta.tag} {repo_meta.repo_name}: not cloned")
+		return None
+	head = gitparse.head_hash(repo_dir)
+	if head is None or head == repo_meta.last_commit_hash:
+		return None
+	return head
+
+# Parse a repository up to `head`, oldest first and after `cursor` (see `GitStatCache.checkpoint`), in batches of `batch_size` commits.
+def commit_batches(repository_directory:str, last_hash:str, start_date:int, batch_size:int, cursor:str=None, head:str=None,
+				   known_stats=None) -> Iterator[gitparse.CommitBatch]:
+	batch = gitparse.CommitBatch()
+	for commit in gitparse.iter_commits_oldest_first(repository_directory, last_hash=last_hash, start_date=start_date, cursor=cursor, head=head, known_stats=known_stats):
+		batch.append(commit)
+		if len(batch) == batch_size:
+			yield batch
+			batch = gitparse.CommitBatch()
+	if len(batch) != 0:
+		yield batch
+
+# Runs in a worker process: sends the commits of a repository to the writer (see `commit_batches`).
+def _mine_repository(key:int, repository_directory:str, last_hash:str, start_date:int, batch_size:int, repo:str=None, metrics_enabled:bool=False,
+					 cursor:str=None, head:str=None):
+	error = None
+	metrics = gitstat_metrics.METRICS
+	metrics.enabled = metrics_enabled
+	metrics.reset()
+	try:
+		with metrics.timer("ingest.parse", repo):
+			for batch in commit_batches(repository_directory, last_hash, start_date, batch_size, cursor, head, _known_stats):
+				_queue.put((MESSAGE_COMMITS, key, batch))
+	except Exception as e:
+		error = f"{type(e).__name__}: {e}"
+	if metrics_enabled:
+		_queue.put((MESSAGE_METRICS, key, metrics.snapshot()))
+	_queue.put((MESSAGE_DONE, key, error))
+
+# Parses many repositories at once in a process pool (`ingest`), or a single one in the calling process (`ingest_repository`).
+# All rows are written by the calling process, which is the only one using the `GitStatCache` connection.
+# Every batch is committed as a checkpoint, so a failed or interrupted repository keeps the commits ingested so far and
+# continues from there the next time.
+class IngestScheduler:
+
+	def __init__(self, cache:GitStatCache, max_workers:int=None, batch_size:int=INGEST_BATCH_SIZE):
+		self.cache = cache
+		self.max_workers = max_workers or os.cpu_count()
+		self.batch_size = batch_size
+
+	# The commit to ingest `repo_meta` up to and the cursor to continue after (see `ingest_head`), or None
+	def _start(self, repo_meta:RepoMeta) -> Tuple[str, str]:
+		head = ingest_head(self.cache.config, repo_meta)
+		if head is None:
+			return None
+		with self.cache.lock:
+			cursor = self.cache.load_cursor(repo_meta)
+		if cursor:
+			log.info(f"Resuming {repo_meta.tag} {repo_meta.repo_name} after {cursor}")
+		return head, cursor
+
+	# Ingest `repo_meta` in the calling process. The cache is used under `GitStatCache.lock`, so that threads can ingest
+	# different repositories at once (see `GitStatDaemon`). Returns the number of new commits.
+	def ingest_repository(self, repo_meta:RepoMeta) -> int:
+		start = self._start(repo_meta)
+		if start is None:
+			return 0
+		head, cursor = start
+		config = self.cache.config
+		repo_dir = config.repo_directory(repo_meta)
+		known_stats = self.cache.known_stats if config.deduplicate_commits else None
+		commit_count = 0
+		try:
+			for batch in commit_batches(repo_dir, repo_meta.last_commit_hash, config.max_history_time, self.batch_size, cursor, head, known_stats):
+				with self.cache.lock:
+					commit_count = commit_count + self.cache.checkpoint(repo_meta, batch)
+		finally:
+			# The diff-tree workers (see `known_stats`) are only kept while a repository is ingested, so that their number
+			# does not grow with the number of repositories
+			gitparse.gitparse_worker.shared_pool().close(repo_dir)
+		with self.cache.lock:
+			self.cache.complete_ingest(repo_meta, head)
+		return commit_count
+
+	def ingest(self, repo_metas:List[RepoMeta]) -> List[RepoMeta]:
+		if len(repo_metas) == 0:
+			return repo_metas
+		config = self.cache.config
+		message_queue = multiprocessing.Queue(maxsize=self.max_workers * 4)
+		pending = dict()
+		futures = dict()
+		# Repositories whose rows could not be written. Their remaining messages are drained, so that the workers do not block.
+		write_failed = set()
+		db_path = self.cache.db_path if config.deduplicate_commits else None
+		with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker, initargs=(message_queue, db_path)) as executor:
+			for (key, repo_meta) in enumerate(repo_metas):
+				start = self._start(repo_meta)
+				if start is None:
+					continue
+				head, cursor = start
+				pending[key] = (repo_meta, head)
+				futures[key] = executor.submit(_mine_repository, key, config.repo_directory(repo_meta), repo_meta.last_commit_hash, config.max_history_time, self.batch_size,
+											   gitstat_metrics.repo_label(repo_meta), gitstat_metrics.METRICS.enabled, cursor, head)
+
+			while len(pending) != 0:
+				try:
+					message, key, payload = message_queue.get(timeout=1)
+				except queue.Empty:
+					# A worker process that died never reports back
+					for key in [key for key in pending.keys() if futures[key].done() and futures[key].exception()]:
+						repo_meta, _ = pending.pop(key)
+						log.error(f"Failed to ingest {repo_meta.tag} {repo_meta.repo_name}: {futures[key].exception()}")
+						if key not in write_failed:
+							repo_meta.failed = repo_meta.failed + 1
+					continue
+				repo_meta, head = pending[key]
+				if message == MESSAGE_METRICS:
+					gitstat_metrics.METRICS.merge(payload)
+					continue
+				if message == MESSAGE_DONE:
+					del pending[key]
+				if key in write_failed:
+					continue
+				try:
+					if message == MESSAGE_COMMITS:
+						self.cache.checkpoint(repo_meta, payload)
+					elif payload is not None:
+						# The checkpointed commits are kept, and the next ingestion continues after them
+						log.error(f"Failed to ingest {repo_meta.tag} {repo_meta.repo_name}: {payload}")
+						repo_meta.failed = repo_meta.failed + 1
+					else:
+						self.cache.complete_ingest(repo_meta, head)
+						log.info(f"Ingested {repo_meta.tag} {repo_meta.repo_name}")
+				except Exception as e:
+					log.error(f"Failed to store the commits of {repo_meta.tag} {repo_meta.repo_name}: {type(e).__name__}: {e}")
+					self.cache.db.rollback()
+					repo_meta.failed = repo_meta.failed + 1
+					write_failed.add(key)
+		return repo_metas
+
+	def ingest_all(self, repos_metas:Dict[str, List[RepoMeta]]) -> Dict[str, List[RepoMeta]]:
+		originals = [repo_meta for repo_metas in repos_metas.values() for repo_meta in repo_metas]
+		# `load_meta` returns the original for repositories that are not in the cache yet, so the failures are counted from
+		# the values before the ingestion
+		cached = [self.cache.load_meta(repo_meta) for repo_meta in originals]
+		failed = [(original.failed, cached_meta.failed) for (original, cached_meta) in zip(originals, cached)]
+		self.ingest(cached)
+		for (original, cached_meta, (original_failed, cached_failed)) in zip(originals, cached, failed):
+			original.last_commit_hash = cached_meta.last_commit_hash
+			original.failed = original_failed + cached_meta.failed - cached_failed
+		return repos_metas
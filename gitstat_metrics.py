@@ -0,0 +1,188 @@
+import json
+import time
+import threading
+import contextlib
+from typing import Dict, Callable
+import logging
+
+from common import GIT_PARSE_LOGGER_ID
+
+log = logging.getLogger(GIT_PARSE_LOGGER_ID)
+
+# Timers and counters for the stages of a synchronisation. Metrics are disabled by default; `enable` turns them on:
+#
+#     gitstat_metrics.enable(gitstat_metrics.LogSink(), gitstat_metrics.JsonFileSink("metrics.json"))
+#
+# Names used by gitstat:
+#
+# timers:   metadata, fetch, fetch.repository, ingest, ingest.parse, mine_stats, cache.insert, cache.aggregate, frames
+# counters: http.requests, http.cache_hits, git.subprocesses, git.bytes_read, git.commits, git.commits_reused, cache.rows_inserted,
+#           cache.checkpoints
+#
+# Timers and counters can also be recorded for a repository ("<tag>/<name>", see `repo_label`).
+# While disabled, `timer` and `count` return immediately.
+
+# A snapshot of `Metrics`, as passed to the sinks:
+# {"counters": {name: value}, "timers": {name: {"count": n, "seconds": s}}, "repositories": {repo: {"counters": ..., "timers": ...}}}
+
+def repo_label(repo_meta) -> str:
+	return f"{repo_meta.tag}/{repo_meta.repo_name}"
+
+def _empty() -> Dict:
+	return {"counters": dict(), "timers": dict()}
+
+# Writes the snapshot to the log
+class LogSink:
+
+	def __init__(self, level:int=logging.INFO):
+		self.level = level
+
+	def __call__(self, snapshot:Dict):
+		for (name, value) in sorted(snapshot["counters"].items()):
+			log.log(self.level, f"metrics: {name} = {value}")
+		for (name, timer) in sorted(snapshot["timers"].items()):
+			log.log(self.level, f"metrics: {name} = {timer['seconds']:.3f}s ({timer['count']}x)")
+
+# Writes the snapshot to a JSON file, replacing its contents
+class JsonFileSink:
+
+	def __init__(self, path:str):
+		self.path = path
+
+	def __call__(self, snapshot:Dict):
+		with open(self.path, "w") as metrics_file:
+			json.dump(snapshot, metrics_file, indent=2)
+
+# Passes the snapshot to `callback`
+class CallbackSink:
+
+	def __init__(self, callback:Callable[[Dict], None]):
+		self.callback = callback
+
+	def __call__(self, snapshot:Dict):
+		self.callback(snapshot)
+
+class _Timer:
+
+	__slots__ = ('metrics', 'name', 'repo', 'start')
+
+	def __init__(self, metrics:'Metrics', name:str, repo:str):
+		self.metrics = metrics
+		self.name = name
+		self.repo = repo
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *_):
+		self.metrics.record(self.name, time.perf_counter() - self.start, self.repo)
+		return False
+
+_NULL_TIMER = contextlib.nullcontext()
+
+class Metrics:
+
+	def __init__(self):
+		self.enabled = False
+		self.sinks = []
+		self._lock = threading.Lock()
+		self._metrics = _empty()
+		self._repositories = dict()
+
+	def _target(self, repo:str) -> Dict:
+		if repo is None:
+			return self._metrics
+		if repo not in self._repositories:
+			self._repositories[repo] = _empty()
+		return self._repositories[repo]
+
+	# Add `value` to the counter `name` (of `repo`)
+	def count(self, name:str, value:int=1, repo:str=None):
+		if not self.enabled:
+			return
+		with self._lock:
+			counters = self._metrics["counters"]
+			counters[name] = counters.get(name, 0) + value
+			if repo is not None:
+				counters = self._target(repo)["counters"]
+				counters[name] = counters.get(name, 0) + value
+
+	# Add `seconds` to the timer `name` (of `repo`)
+	def record(self, name:str, seconds:float, repo:str=None):
+		if not self.enabled:
+			return
+		with self._lock:
+			for target in [self._metrics] if repo is None else [self._metrics, self._target(repo)]:
+				timer = target["timers"].setdefault(name, {"count": 0, "seconds": 0.0})
+				timer["count"] = timer["count"] + 1
+				timer["seconds"] = timer["seconds"] + seconds
+
+	# Context manager timing its block as `name` (of `repo`)
+	def timer(self, name:str, repo:str=None):
+		if not self.enabled:
+			return _NULL_TIMER
+		return _Timer(self, name, repo)
+
+	def snapshot(self) -> Dict:
+		with self._lock:
+			return json.loads(json.dumps(dict(self._metrics, repositories=self._repositories)))
+
+	# Add a snapshot (i.e. from a worker process) to the metrics
+	def merge(self, snapshot:Dict):
+		if not self.enabled:
+			return
+		for (name, value) in snapshot["counters"].items():
+			self.count(name, value)
+		for (name, timer) in snapshot["timers"].items():
+			self._merge_timer(name, timer, None)
+		for (repo, metrics) in snapshot.get("repositories", dict()).items():
+			for (name, value) in metrics["counters"].items():
+				with self._lock:
+					counters = self._target(repo)["counters"]
+					counters[name] = counters.get(name, 0) + value
+			for (name, timer) in metrics["timers"].items():
+				self._merge_timer(name, timer, repo)
+
+	def _merge_timer(self, name:str, timer:Dict, repo:str):
+		with self._lock:
+			target = self._target(repo)["timers"].setdefault(name, {"count": 0, "seconds": 0.0})
+			target["count"] = target["count"] + timer["count"]
+			target["seconds"] = target["seconds"] + timer["seconds"]
+
+	def reset(self):
+		with self._lock:
+			self._metrics = _empty()
+			self._repositories = dict()
+
+	# Pass a snapshot to all sinks
+	def flush(self):
+		if not self.enabled:
+			return
+		snapshot = self.snapshot()
+		for sink in self.sinks:
+			try:
+				sink(snapshot)
+			except Exception as e:
+				log.error(f"Metrics sink {sink} failed: {e}")
+
+# The metrics of this process
+METRICS = Metrics()
+
+def enable(*sinks):
+	METRICS.sinks = list(sinks)
+	METRICS.enabled = True
+
+def disable():
+	METRICS.enabled = False
+	METRICS.sinks = []
+	METRICS.reset()
+
+def timer(name:str, repo:str=None):
+	return METRICS.timer(name, repo)
+
+def count(name:str, value:int=1, repo:str=None):
+	METRICS.count(name, value, repo)
+
+def flush():
+	METRICS.flush()
@@ -1,8 +1,27 @@
 from typing import List, Dict
-import requests
 import os
 import gitparse
 
+# How repositories are stored on disk (see `GitStatConfig.storage_mode`). Only commit metadata and diff stats are
+# needed, so everything but "full" limits the history to `GitStatConfig.max_history_time`.
+STORAGE_FULL = "full"
+# Shallow clone of the history since `max_history_time`
+STORAGE_SHALLOW = "shallow"
+# Shallow partial clone without blobs. Blobs are fetched from the remote in batches when a commit is diffed.
+STORAGE_BLOBLESS = "blobless"
+# Shallow partial clone without trees and blobs. Smallest clone, but diffing fetches trees one by one.
+STORAGE_TREELESS = "treeless"
+
+STORAGE_MODES = [STORAGE_FULL, STORAGE_SHALLOW, STORAGE_BLOBLESS, STORAGE_TREELESS]
+
+# Intervals (in seconds) for which `GitStatCache` maintains precomputed period sums. A month is 30 days.
+ROLLUP_INTERVALS = {
+	"hour": 3600,
+	"day": 24 * 3600,
+	"week": 7 * 24 * 3600,
+	"month": 30 * 24 * 3600,
+}
+
 class RepoMapping:
 	def __init__(self, org:str, tag:str=None, max_count:int=0, ignore_repos: List[str] = []):
 		self.org = org
@@ -14,7 +33,7 @@ class RepoMapping:
 			self.tag = tag
 
 class RepoMeta:
-	def __init__(self, repo_id:int=0, default_branch:str=None, url:str=None, name:str=None, stars:int=0, watchers:int=0, forks:int=0, size:int=0, tag:str=None, is_cloned:bool=False, last_commit_hash:str=None, db_row=None):
+	def __init__(self, repo_id:int=0, default_branch:str=None, url:str=None, name:str=None, stars:int=0, watchers:int=0, forks:int=0, size:int=0, tag:str=None, is_cloned:bool=False, last_commit_hash:str=None, pushed_at:str=None, db_row=None):
 		
 		if db_row:
 			self.update(db_row)
@@ -31,6 +50,9 @@ class RepoMeta:
 			self.is_cloned = is_cloned
 			self.failed = 0
 			self.last_commit_hash = last_commit_hash
+			# `pushed_at` as reported by GitHub and the remote HEAD, as of the last successful fetch
+			self.pushed_at = pushed_at
+			self.remote_head = None
 
 	@property
 	def as_dict(self):
@@ -46,11 +68,14 @@ class RepoMeta:
 			"tag" : self.tag,
 			"is_cloned" : self.is_cloned,
 			"failed" : self.failed,
-			"last_commit_hash" : self.last_commit_hash
+			"last_commit_hash" : self.last_commit_hash,
+			"pushed_at" : self.pushed_at,
+			"remote_head" : self.remote_head
 		}
 
 	def update(self, db_row):
-		_, self.id, self.repo_name, self.default_branch, self.url, self.stars, self.forks, self.size, self.tag, self.is_cloned, self.failed, self.last_commit_hash = db_row
+		_, self.id, self.repo_name, self.default_branch, self.url, self.stars, self.forks, self.size, self.tag, self.is_cloned, self.failed, self.last_commit_hash, self.pushed_at, self.remote_head = db_row
+		self.watchers = 0
 
 	@property
 	def name(self):
@@ -73,10 +98,21 @@ class GitStatEntry:
 		self.deletions = deletions
 
 	def add(self, commit:gitparse.CommitData):
-		self.change_count = self.change_count + commit.insertions + commit.deletions
+		self.add_stats(commit.insertions, commit.deletions)
+
+	# Add a commit with `insertions` and `deletions`
+	def add_stats(self, insertions:int, deletions:int):
+		self.change_count = self.change_count + insertions + deletions
 		self.commit_count = self.commit_count + 1
-		self.insertions = self.insertions + commit.insertions
-		self.deletions = self.deletions + commit.deletions
+		self.insertions = self.insertions + insertions
+		self.deletions = self.deletions + deletions
+
+	# Add the stats of another entry for the same period
+	def merge(self, entry:'GitStatEntry'):
+		self.change_count = self.change_count + entry.change_count
+		self.commit_count = self.commit_count + entry.commit_count
+		self.insertions = self.insertions + entry.insertions
+		self.deletions = self.deletions + entry.deletions
 
 	@property
 	def as_dict(self):
@@ -107,14 +143,54 @@ class GitStatRepository:
 		return f"git_stat_period_{self.repo_meta.name}_{self.period_interval}"
 
 class GitStatConfig:
-	def __init__(self, repository_path:str, cache_path:str = "./cache", max_history_time:int=0, include_forks:bool=False, repos_per_page:int=100, base_url:str="https://api.github.com", network=requests):
+	def __init__(self, repository_path:str, cache_path:str = "./cache", max_history_time:int=0, include_forks:bool=False, repos_per_page:int=100, base_url:str="https://api.github.com", network=None, ingest_workers:int=None, fetch_workers:int=8, storage_mode:str=STORAGE_FULL, bare:bool=False, metadata_workers:int=8, deduplicate_commits:bool=False):
 		self.repository_path = repository_path
 		self.cache_path = cache_path
 		self.max_history_time = max_history_time
 		self.repos_per_page = repos_per_page
 		self.base_url = base_url
-		self.network = network
+		# Any object with a `requests`-like `get(url, headers=...)`. Defaults to the `requests` module.
+		self._network = network
 		self.include_forks = include_forks
+		# Number of repositories parsed in parallel. Defaults to the number of CPUs.
+		self.ingest_workers = ingest_workers
+		# Number of repositories cloned or updated in parallel
+		self.fetch_workers = fetch_workers
+		if storage_mode not in STORAGE_MODES:
+			raise ValueError(f"Unknown storage mode '{storage_mode}'. Use one of {STORAGE_MODES}.")
+		self.storage_mode = storage_mode
+		# Clone without a working tree
+		self.bare = bare
+		# Number of organisations whose metadata is fetched concurrently
+		self.metadata_workers = metadata_workers
+		# Reuse the stats of commits that are already in the cache (from forks and mirrors) instead of diffing them again
+		self.deduplicate_commits = deduplicate_commits
+
+	# `requests` is imported when it is first used
+	@property
+	def network(self):
+		if self._network is None:
+			import requests
+			self._network = requests
+		return self._network
+
+	@network.setter
+	def network(self, value):
+		self._network = value
+
+	@property
+	def partial_clone_filter(self) -> str:
+		if self.storage_mode == STORAGE_BLOBLESS:
+			return "blob:none"
+		if self.storage_mode == STORAGE_TREELESS:
+			return "tree:0"
+		return None
+
+	@property
+	def shallow_since(self) -> int:
+		if self.storage_mode == STORAGE_FULL or not self.max_history_time:
+			return None
+		return self.max_history_time
 
 	def tag_directory(self, tag:str):
 		return os.path.join(self.repository_path, tag)
@@ -1,10 +1,13 @@
 import pandas as pd
+import numpy as np
 import os
-from typing import List, Dict
+from typing import List, Dict, Union
 import logging
 
 import gitstat
+import gitstat_metrics
 from common import ensure_path
+from gitstat_store import FrameStore, FORMAT_NPY
 from gitstat_models import *
 
 log = logging.getLogger(gitstat.LOGGER_TAG)
@@ -29,7 +32,8 @@ class GitStatData:
 	def df(self, value:pd.DataFrame):
 		self._df = value
 		if not self._columns:
-			self._columns = [next(col for col in self._df.columns if col != "timestamp")]
+			# A frame without data columns (i.e. empty) leaves the columns unset
+			self._columns = [col for col in self._df.columns if col != "timestamp"][:1]
 
 	@property
 	def columns(self):
@@ -47,24 +51,72 @@ class GitStatData:
 	def available_column_names(self) -> List[str]:
 		all_columns = [col for col in self.df.columns if col != "timestamp"]
 
+# Sum commits per period of `interval` seconds without creating an object per commit. The timestamp of a period is its
+# end, like `GitStats.calculate_timestamp`. Columns are the same as the ones of `GitStatEntry.as_dict`.
+def bin_commits(timestamps:np.ndarray, insertions:np.ndarray, deletions:np.ndarray, interval:int) -> pd.DataFrame:
+	periods, period_index = np.unique(np.floor_divide(timestamps, interval), return_inverse=True)
+	return stats_frame((periods + 1) * interval,
+					   np.bincount(period_index, minlength=len(periods)),
+					   np.bincount(period_index, weights=insertions, minlength=len(periods)).astype(np.int64),
+					   np.bincount(period_index, weights=deletions, minlength=len(periods)).astype(np.int64))
+
+def stats_frame(timestamps:np.ndarray, commit_counts:np.ndarray, insertions:np.ndarray, deletions:np.ndarray) -> pd.DataFrame:
+	return pd.DataFrame({
+		"commit_count": commit_counts,
+		"timestamp": timestamps,
+		"change_count": insertions + deletions,
+		"insertions": insertions,
+		"deletions": deletions,
+	})
+
 class GitStatPd:
 
-	def __init__(self, config: gitstat.GitStatConfig):
+	# `incremental`: only recompute the periods that received new commits since the last `synchronize` and merge them into the stored frames
+	# `segment_format`: how frames are stored (see `gitstat_store.FORMAT_NPY` and `gitstat_store.FORMAT_PICKLE`)
+	def __init__(self, config: gitstat.GitStatConfig, incremental:bool=True, segment_format:str=FORMAT_NPY):
 		self.config = config
 		self.gitstat = gitstat.GitStats(config)
+		self.incremental = incremental
+		self.store = FrameStore(os.path.join(config.cache_path, "frames"), segment_format)
+
+	# Stored with a frame. A frame can only be updated incrementally if it was created from the same repositories and history limit.
+	def _frame_state(self, repo_names:List[str], watermark:int) -> Dict:
+		return {"watermark": watermark, "repos": sorted(repo_names), "max_history_time": self.config.max_history_time}
 
-	def _save_frame(self, data:GitStatData):
-		pd.DataFrame.to_pickle(data.df, self._file_name_for(data))
+	def _save_frame(self, data:GitStatData, state:Dict=None):
+		self.store.write(data.file_name, data.df, state or {})
 
 	def _file_name_for(self, data:GitStatData):
 		ensure_path(self.config.cache_path)
 		return os.path.join(self.config.cache_path, f"{data.file_name}.pkl")
 
-	def load(self, data:GitStatData) -> GitStatData:
-		data.df = pd.read_pickle(self._file_name_for(data))
+	# Only `data.columns` (if set) and the rows with `start` <= timestamp < `end` are loaded
+	def load(self, data:GitStatData, start:int=None, end:int=None) -> GitStatData:
+		df = self.store.read(data.file_name, data.columns, start, end)
+		if df is None:
+			# Frames saved before `FrameStore` was used
+			df = pd.read_pickle(self._file_name_for(data))
+		data.df = df
 		return data
 
-	def synchronize(self, source:List[gitstat.RepoMapping], interval:int, load_meta_from_github:bool=True, update_repos=True) -> [GitStatData]:
+	# Returns the earliest timestamp that needs to be recomputed for the stored frame `data`, 0 if nothing changed or None if
+	# the frame has to be recreated.
+	def _recompute_since(self, data:GitStatData, repo_names:List[str]) -> int:
+		if not self.incremental:
+			return None
+		manifest = self.store.manifest(data.file_name)
+		if manifest is None:
+			return None
+		state = manifest["state"]
+		if state.get("repos") != sorted(repo_names) or state.get("max_history_time") != self.config.max_history_time:
+			return None
+		earliest = self.gitstat.cache.earliest_commit_since(data.tag, repo_names, state["watermark"], self.config.max_history_time)
+		return earliest or 0
+
+	# `interval` is a period length in seconds, or a list of them. Frames for all intervals are created from a single scan of the cache.
+	# The metrics of the stages are flushed (see `gitstat_metrics`) once all frames have been loaded.
+	def synchronize(self, source:List[gitstat.RepoMapping], interval:Union[int, List[int]], load_meta_from_github:bool=True, update_repos=True) -> [GitStatData]:
+		intervals = interval if isinstance(interval, list) else [interval]
 		repositories_metas = None
 		if not load_meta_from_github:
 			repositories_metas = self.gitstat.load_metas_from_cache(source)
@@ -74,15 +126,50 @@ class GitStatPd:
 			repositories_metas = self.gitstat.download_source_code(repositories_metas)
 		
 		repositories_metas = self.gitstat.update_cache(repositories_metas)
+		watermark = self.gitstat.cache.commit_watermark()
 
 		for tag, repo_metas in repositories_metas.items():
 
-			stats_objects =  self.gitstat.generate_stats(interval, repo_metas)
-			stats_dicts = [entry.as_dict for entry in stats_objects]
-			assert(len(stats_dicts))
-			stats = pd.DataFrame(stats_dicts)
-			stats = stats.rename(columns=lambda x: GitStatData.get_column_name(x, tag, interval) if x != "timestamp" else x).sort_values(by="timestamp")
-			data = GitStatData(tag, interval, stats)
-			self._save_frame(data)
-			
-			yield GitStatData(tag, interval, stats)
+			repo_names = [repo_meta.repo_name for repo_meta in repo_metas]
+			since = {frame_interval: self._recompute_since(GitStatData(tag, frame_interval), repo_names) for frame_interval in intervals}
+			changed = [frame_interval for frame_interval in intervals if since[frame_interval] != 0]
+
+			with gitstat_metrics.timer("frames"):
+				for (frame_interval, stats) in self.generate_frames(tag, repo_metas, changed, since).items():
+					data = GitStatData(tag, frame_interval, stats)
+					state = self._frame_state(repo_names, watermark)
+					if since[frame_interval] is None:
+						assert(len(stats))
+						self._save_frame(data, state)
+					else:
+						self.store.merge_tail(data.file_name, stats, state)
+
+			for frame_interval in intervals:
+				yield self.load(GitStatData(tag, frame_interval))
+
+		gitstat_metrics.flush()
+
+	# Create a frame per interval for the repositories of `tag`. Standard intervals are read from the rollups of the cache,
+	# the commits are read from the cache once for all other intervals.
+	# `since` maps intervals to a timestamp: only the periods from the one containing it are created.
+	def generate_frames(self, tag:str, repo_metas:List[RepoMeta], intervals:List[int], since:Dict[int, int]=None) -> Dict[int, pd.DataFrame]:
+		cache = self.gitstat.cache
+		repo_names = [repo_meta.repo_name for repo_meta in repo_metas]
+		since = since or dict()
+		scanned = [interval for interval in intervals if not cache.has_rollup(interval)]
+		commits = None
+		if len(scanned) != 0:
+			# Start the scan at the beginning of the earliest period that is recomputed
+			start = min([(since[interval] // interval) * interval if since.get(interval) else 0 for interval in scanned])
+			commits = cache.commit_arrays(tag, repo_names, max(start, self.config.max_history_time))
+		frames = dict()
+		for interval in intervals:
+			first_period = (since[interval] // interval + 1) * interval if since.get(interval) else None
+			if interval in scanned:
+				stats = bin_commits(*commits, interval)
+				if first_period is not None:
+					stats = stats[stats["timestamp"] >= first_period].reset_index(drop=True)
+			else:
+				stats = stats_frame(*cache.rollup_arrays(interval, tag, repo_names, since.get(interval)))
+			frames[interval] = stats.rename(columns=lambda x: GitStatData.get_column_name(x, tag, interval) if x != "timestamp" else x)
+		return frames
@@ -0,0 +1,158 @@
+import os
+import json
+import shutil
+from typing import List, Dict
+import logging
+
+import numpy as np
+import pandas as pd
+
+from common import ensure_path, GIT_PARSE_LOGGER_ID
+
+log = logging.getLogger(GIT_PARSE_LOGGER_ID)
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+# A frame is compacted into a single segment when it has more segments than this
+MAX_SEGMENTS = 32
+
+# Segment formats. "npy" stores one `.npy` file per column, which is read memory mapped and without unpickling.
+FORMAT_NPY = "npy"
+FORMAT_PICKLE = "pickle"
+
+# Stores stats frames (sorted by "timestamp") as a directory of append-only segments and a manifest:
+#
+# <directory>/<name>/manifest.json
+# <directory>/<name>/segment_<n>/<column index>.npy   (FORMAT_NPY)
+# <directory>/<name>/segment_<n>.pkl                  (FORMAT_PICKLE)
+#
+# `merge_tail` replaces the rows from the first timestamp of a recomputed tail onwards, so only the
+# segments that overlap the tail are rewritten.
+class FrameStore:
+
+	def __init__(self, directory:str, segment_format:str=FORMAT_NPY):
+		self.directory = directory
+		self.segment_format = segment_format
+
+	def frame_directory(self, name:str) -> str:
+		return os.path.join(self.directory, name)
+
+	def manifest(self, name:str) -> Dict:
+		path = os.path.join(self.frame_directory(name), MANIFEST_FILE_NAME)
+		if not os.path.isfile(path):
+			return None
+		with open(path) as manifest_file:
+			return json.load(manifest_file)
+
+	def _write_manifest(self, name:str, manifest:Dict):
+		path = os.path.join(self.frame_directory(name), MANIFEST_FILE_NAME)
+		with open(path + ".tmp", "w") as manifest_file:
+			json.dump(manifest, manifest_file)
+		os.replace(path + ".tmp", path)
+
+	def _segment_path(self, name:str, segment:Dict) -> str:
+		return os.path.join(self.frame_directory(name), segment["file"])
+
+	# Read the rows of a segment with `start` <= timestamp < `end`. Columns of npy segments are memory mapped and sliced without copying.
+	def _read_segment(self, name:str, segment:Dict, columns:List[str]=None, start:int=None, end:int=None) -> pd.DataFrame:
+		if segment.get("format", FORMAT_PICKLE) == FORMAT_PICKLE:
+			df = pd.read_pickle(self._segment_path(name, segment))
+			if start is not None:
+				df = df[df["timestamp"] >= start]
+			if end is not None:
+				df = df[df["timestamp"] < end]
+			return df[columns] if columns else df
+
+		path = self._segment_path(name, segment)
+		load = lambda column: np.load(os.path.join(path, f"{segment['columns'].index(column)}.npy"), mmap_mode="r", allow_pickle=False)
+		timestamps = load("timestamp")
+		first = 0 if start is None else np.searchsorted(timestamps, start, side="left")
+		last = len(timestamps) if end is None else np.searchsorted(timestamps, end, side="left")
+		return pd.DataFrame({column: load(column)[first:last] for column in (columns or segment["columns"])}, copy=False)
+
+	def _write_segment(self, name:str, manifest:Dict, df:pd.DataFrame) -> Dict:
+		segment = {
+			"format": self.segment_format,
+			"first": int(df["timestamp"].iloc[0]),
+			"last": int(df["timestamp"].iloc[-1]),
+			"rows": len(df),
+		}
+		if self.segment_format == FORMAT_PICKLE:
+			segment["file"] = f"segment_{manifest['next_segment']}.pkl"
+			pd.DataFrame.to_pickle(df, self._segment_path(name, segment))
+		else:
+			segment["file"] = f"segment_{manifest['next_segment']}"
+			segment["columns"] = [str(column) for column in df.columns]
+			path = self._segment_path(name, segment)
+			ensure_path(path)
+			for (i, column) in enumerate(df.columns):
+				np.save(os.path.join(path, f"{i}.npy"), df[column].to_numpy(), allow_pickle=False)
+		manifest["next_segment"] = manifest["next_segment"] + 1
+		return segment
+
+	def _remove_segments(self, name:str, segments:List[Dict]):
+		for segment in segments:
+			path = self._segment_path(name, segment)
+			if os.path.isfile(path):
+				os.remove(path)
+			elif os.path.isdir(path):
+				shutil.rmtree(path)
+
+	# The columns of a stored frame. Manifests written before they were stored only have the columns of npy segments.
+	@staticmethod
+	def _columns(manifest:Dict) -> List[str]:
+		if "columns" in manifest:
+			return manifest["columns"]
+		return next((segment["columns"] for segment in manifest["segments"] if "columns" in segment), [])
+
+	# Read a frame, or only `columns` ("timestamp" is always included) of the rows with `start` <= timestamp < `end`.
+	# Segments outside of the range are not opened.
+	def read(self, name:str, columns:List[str]=None, start:int=None, end:int=None) -> pd.DataFrame:
+		manifest = self.manifest(name)
+		if manifest is None:
+			return None
+		if columns:
+			columns = ["timestamp"] + [column for column in columns if column != "timestamp"]
+		segments = [segment for segment in manifest["segments"]
+					if (start is None or segment["last"] >= start) and (end is None or segment["first"] < end)]
+		if len(segments) == 0:
+			return pd.DataFrame(columns=columns or self._columns(manifest))
+		if len(segments) == 1:
+			return self._read_segment(name, segments[0], columns, start, end)
+		return pd.concat([self._read_segment(name, segment, columns, start, end) for segment in segments], ignore_index=True)
+
+	# Replace the stored frame. `state` is kept in the manifest (see `merge_tail`).
+	def write(self, name:str, df:pd.DataFrame, state:Dict):
+		ensure_path(self.frame_directory(name))
+		previous = self.manifest(name)
+		manifest = {"next_segment": previous["next_segment"] if previous else 0, "segments": [], "state": state, "columns": [str(column) for column in df.columns]}
+		if len(df) != 0:
+			manifest["segments"].append(self._write_segment(name, manifest, df))
+		self._write_manifest(name, manifest)
+		if previous:
+			self._remove_segments(name, previous["segments"])
+
+	# Replace all rows with a timestamp >= the first timestamp of `tail` by `tail`
+	def merge_tail(self, name:str, tail:pd.DataFrame, state:Dict):
+		manifest = self.manifest(name)
+		if len(tail) == 0:
+			manifest["state"] = state
+			self._write_manifest(name, manifest)
+			return
+		tail_start = int(tail["timestamp"].iloc[0])
+		kept = [segment for segment in manifest["segments"] if segment["last"] < tail_start]
+		replaced = [segment for segment in manifest["segments"] if segment["last"] >= tail_start]
+		for segment in replaced:
+			if segment["first"] < tail_start:
+				# Only the part before the tail is kept
+				df = self._read_segment(name, segment)
+				kept.append(self._write_segment(name, manifest, df[df["timestamp"] < tail_start]))
+		kept.append(self._write_segment(name, manifest, tail))
+		manifest["segments"] = kept
+		manifest["columns"] = [str(column) for column in tail.columns]
+		manifest["state"] = state
+		self._write_manifest(name, manifest)
+		self._remove_segments(name, replaced)
+		if len(manifest["segments"]) > MAX_SEGMENTS:
+			log.info(f"Compacting {name}")
+			self.write(name, self.read(name), state)